@@ -15,7 +15,37 @@ See README.md for more details
 
 import sys
 import re
-import cgi
+import os
+import json
+import gzip
+import hashlib
+import argparse
+import posixpath
+import shutil
+import queue
+import signal
+import sqlite3
+import socket
+import socketserver
+import stat
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from html import escape, unescape
+from urllib.parse import unquote
+
+# Pygments is optional. If it is installed it is used to highlight code
+# sections, otherwise the simple built-in tokenizer is used instead.
+try:
+    import pygments
+    import pygments.lexers
+    import pygments.formatters
+    import pygments.util
+except ImportError:
+    pygments = None
 
 KIWI_MODE_STD = 0
 KIWI_MODE_ORG = 1
@@ -94,6 +124,13 @@ CODEBLOCK_START_REGEX = r"^[\s]*code:([^\s]*)[\s]*$"
 # own.
 CODEBLOCK_END_REGEX = r"^[\s]*:code[\s]*$"
 
+# ORG_MODE_REGEX matches the first line of an org-mode file
+ORG_MODE_REGEX = r"-*- mode: org -*-"
+
+# Version of the KiwiMarkup checkpoint format. This must be changed whenever
+# the processor state changes, so that old checkpoints are rejected.
+CHECKPOINT_VERSION = 1
+
 class KiwiMarkup:
     """
     Main processing class. Call the execute() method to process a list of
@@ -102,9 +139,57 @@ class KiwiMarkup:
     not include any framing <HTML> and <BODY> tags -- it is assumed that
     the calling program will take the output and insert it into an appropriate
     template.
+
+    While the lines are processed the headers, links, images and footnotes
+    are also collected, and on return KiwiMarkup.metadata will hold them
+    (see KiwiMetadata below). If headerIds is True, the generated anchor ids
+    are also added to the header tags, so that a table of contents can link
+    to them.
+
+    If compact is True, the pretty-printing whitespace is left out of the
+    output: tags are not indented, and are joined onto the same line
+    wherever the newline between them is not significant.
+
+    If highlight is True, code sections which name their language (for
+    example 'code:python') are syntax-highlighted -- see KiwiHighlighter.
+
+    If sourceMap is True, KiwiMarkup.sourceMap will hold a (first, last)
+    tuple for each entry of KiwiMarkup.output, giving the range of input
+    line numbers (starting from 1) which produced the entry. Tags which are
+    generated to close a section belong to the line which closed it.
+
+    If collectText is True, the plain text of the headers, paragraphs and
+    list items is also collected into the metadata (see KiwiMetadata.text).
+
+    If checkpoint is True, KiwiMarkup.checkpoint will hold the state of the
+    processor as it was before the final line was processed, so that lines
+    which are later appended to the document can be processed on their own
+    by resume().
     """
 
-    def __init__(self):
+    def __init__(self, headerIds = False, compact = False, highlight = False, sourceMap = False,
+                 collectText = False, checkpoint = False):
+        self.headerIds = headerIds
+        self.keepCheckpoint = checkpoint
+        self.checkpoint = None
+        self.collectText = collectText
+        self.compact = compact
+        self.keepSourceMap = sourceMap
+        self.sourceMap = None
+        self.highlight = highlight
+        self.highlighter = None
+        if highlight:
+            self.highlighter = KiwiHighlighter.shared()
+        if compact:
+            self.rowStart = "<tr>"
+            self.rowEnd = "</tr>"
+            self.headerCell = "<th>%s</th>"
+            self.cell = "<td>%s</td>"
+        else:
+            self.rowStart = "    <tr>"
+            self.rowEnd = "    </tr>"
+            self.headerCell = "        <th>%s</th>"
+            self.cell = "        <td>%s</td>"
         self.state  = KiwiState()
         self.boldStartPattern = re.compile(BOLD_START_REGEX)
         self.boldEndPattern = re.compile(BOLD_END_REGEX)
@@ -118,6 +203,8 @@ class KiwiMarkup:
         self.linkPattern = re.compile(LINK_REGEX)
         self.footnotePattern = re.compile(FOOTNOTE_REGEX)
         self.footnoteTargetPattern = re.compile(FOOTNOTE_TARGET_REGEX)
+        self.orgModePattern = re.compile(ORG_MODE_REGEX)
+        self.line = None
 
     def execute(self, lines, mode = None):
         """
@@ -128,22 +215,50 @@ class KiwiMarkup:
         """
         assert (lines), "No lines provided for processing"
         if (mode == None):
-            mode = KIWI_MODE_STD
-            if len(lines) > 0:
-                # Check the first line to see if this is an
-                # org-mode file, and if it is, override the
-                # mode.
-                if re.search("-*- mode: org -*-", lines[0]):
-                    mode = KIWI_MODE_ORG
+            mode = self.detectMode(lines)
 
+        self.start(mode)
+        self.feed(lines)
+        if self.keepCheckpoint:
+            self.checkpoint = self.saveCheckpoint()
+        self.finish()
+
+        return len(self.output) > 0
+
+    def start(self, mode):
+        """
+        Resets the processor, ready to process a new document.
+        """
         self.mode = mode
-        self.line = KiwiLineScanner(self.mode)
+        self.state = KiwiState()
+        # The scanner's patterns are only compiled once for each mode
+        if self.line is None or self.line.mode != mode:
+            self.line = KiwiLineScanner(mode)
+        else:
+            self.line.reset()
         self.thisLine = None
         self.nextLine = None
         self.indents = []
         self.output = []
-
-        # Process the lines
+        self.pending = []
+        self.pendingText = False
+        self.pendingRange = (0, 0)
+        self.codeLanguage = ""
+        self.codeLines = []
+        self.codeLineNumbers = []
+        self.metadata = KiwiMetadata()
+        self.headerIndexes = []
+        self.lineNumber = 0
+        self.sourceRange = (0, 0)
+        if self.keepSourceMap:
+            self.sourceMap = []
+
+    def feed(self, lines):
+        """
+        Processes the lines. Because each line is processed when the line
+        after it is read, the last line is left pending until finish() is
+        called.
+        """
         for line in lines:
             # The processing often needs to know the contents of the next
             # line, so we read one line ahead. Therefore thisLine is
@@ -152,30 +267,334 @@ class KiwiMarkup:
             self.thisLine = self.nextLine
 
             # Convert tabs to spaces
-            self.nextLine = re.sub("\t", "    ", line.rstrip())
+            self.nextLine = line.rstrip().replace("\t", "    ")
 
             if not self.line.skipNextLine:
                 self.processLine()
             else:
                 # Never skip more than one line
                 self.line.skipNextLine = False
+            self.lineNumber += 1
 
-        # Process the final line
+    def finish(self):
+        """
+        Processes the final line, and closes any open sections.
+        """
         if not self.line.skipNextLine:
             self.thisLine = self.nextLine
             self.nextLine = ""
             self.processLine()
 
         self.endAllSections()
+        self.flushCodeLines()
+        self.flushPending()
+
+    def saveCheckpoint(self):
+        """
+        Returns the complete state of the processor, as it is between feed()
+        and finish(), as a dictionary which can be saved as JSON. Only the
+        number of output entries at that point is included, not the entries
+        themselves.
+        """
+        return {
+            "version": CHECKPOINT_VERSION,
+            "options": self.options(),
+            "mode": self.mode,
+            "state": dict((flag, getattr(self.state, flag)) for flag in KiwiState.FLAGS),
+            "indents": list(self.indents),
+            "nextLine": self.nextLine,
+            "skipNextLine": self.line.skipNextLine,
+            "lineNumber": self.lineNumber,
+            "sourceRange": list(self.sourceRange),
+            "outputOffset": len(self.output),
+            "pending": list(self.pending),
+            "pendingText": self.pendingText,
+            "pendingRange": list(self.pendingRange),
+            "codeLanguage": self.codeLanguage,
+            "codeLines": list(self.codeLines),
+            "codeLineNumbers": list(self.codeLineNumbers),
+            "anchors": sorted(self.metadata.anchors),
+            "anchorCounts": dict(self.metadata.anchorCounts),
+            "sectionAnchor": self.metadata.sectionAnchor,
+        }
+
+    def resume(self, checkpoint, lines, output, sourceMap = None):
+        """
+        Continues processing a document which has had lines appended to it
+        since it was last processed. The checkpoint is the one saved by that
+        processing, output is the KiwiMarkup.output it produced (and
+        sourceMap its source map, if one is being kept), and lines holds just
+        the new lines. On return the output (and source map) is the same as
+        execute() would produce for the whole document, and there is a new
+        checkpoint. The metadata only covers the new lines.
+
+        The instance must be created with the same options as the one which
+        saved the checkpoint, otherwise a ValueError is raised.
+        """
+        if checkpoint.get("version") != CHECKPOINT_VERSION:
+            raise ValueError("Unsupported checkpoint version: %r" % checkpoint.get("version"))
+        if checkpoint["options"] != self.options():
+            raise ValueError("Checkpoint was saved with different options")
+
+        self.start(checkpoint["mode"])
+        for flag, value in checkpoint["state"].items():
+            setattr(self.state, flag, value)
+        self.indents = list(checkpoint["indents"])
+        self.nextLine = checkpoint["nextLine"]
+        self.line.skipNextLine = checkpoint["skipNextLine"]
+        self.lineNumber = checkpoint["lineNumber"]
+        self.sourceRange = tuple(checkpoint["sourceRange"])
+        self.output = list(output[:checkpoint["outputOffset"]])
+        self.pending = list(checkpoint["pending"])
+        self.pendingText = checkpoint["pendingText"]
+        self.pendingRange = tuple(checkpoint["pendingRange"])
+        self.codeLanguage = checkpoint["codeLanguage"]
+        self.codeLines = list(checkpoint["codeLines"])
+        self.codeLineNumbers = list(checkpoint["codeLineNumbers"])
+        self.metadata.anchors = set(checkpoint["anchors"])
+        self.metadata.anchorCounts = dict(checkpoint["anchorCounts"])
+        self.metadata.sectionAnchor = checkpoint["sectionAnchor"]
+        if self.keepSourceMap:
+            self.sourceMap = [tuple(entry) for entry in (sourceMap or [])[:checkpoint["outputOffset"]]]
+
+        self.feed(lines)
+        if self.keepCheckpoint:
+            self.checkpoint = self.saveCheckpoint()
+        self.finish()
 
         return len(self.output) > 0
 
+    def detectMode(self, lines):
+        """
+        Returns the processing mode for the lines, which is KIWI_MODE_STD
+        unless the first line marks this as an org-mode file.
+        """
+        mode = KIWI_MODE_STD
+        if len(lines) > 0:
+            # Check the first line to see if this is an
+            # org-mode file, and if it is, override the
+            # mode.
+            if self.orgModePattern.search(lines[0]):
+                mode = KIWI_MODE_ORG
+        return mode
+
+    def options(self):
+        """
+        Returns the constructor arguments of this instance, so that an
+        equivalent instance can be created in another process.
+        """
+        return {"headerIds": self.headerIds, "compact": self.compact, "highlight": self.highlight,
+                "sourceMap": self.keepSourceMap, "collectText": self.collectText}
+
+    def executeParallel(self, lines, mode = None, workers = None, minChunkLines = 5000):
+        """
+        Equivalent to execute(), but splits a large document into chunks
+        which are rendered across a pool of worker processes. On return
+        KiwiMarkup.output and KiwiMarkup.metadata are exactly the same as
+        they would be from execute().
+
+        The document is only split at points where the processor state is
+        known to be completely reset (see findBoundaries() below). Documents
+        of fewer than minChunkLines lines per worker are rendered serially.
+        """
+        assert (lines), "No lines provided for processing"
+        if (mode == None):
+            mode = self.detectMode(lines)
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        boundaries = []
+        if workers > 1 and len(lines) >= minChunkLines * 2:
+            chunkLines = max(minChunkLines, len(lines) // (workers * 4))
+            boundaries = self.findBoundaries(lines, chunkLines, mode)
+        if not boundaries:
+            return self.execute(lines, mode)
+
+        starts = [0] + boundaries
+        ends = boundaries + [len(lines)]
+        tasks = [(lines[start:end], mode, self.options()) for start, end in zip(starts, ends)]
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            results = list(executor.map(_executeChunk, tasks))
+
+        self.mode = mode
+        self.output = []
+        self.metadata = KiwiMetadata()
+        self.headerIndexes = []
+        if self.keepSourceMap:
+            self.sourceMap = []
+        for start, (output, metadata, headerIndexes, sourceMap) in zip(starts, results):
+            self.mergeChunk(output, metadata, headerIndexes, sourceMap, start)
+
+        return len(self.output) > 0
+
+    def findBoundaries(self, lines, chunkLines, mode = None):
+        """
+        Returns the indexes of the lines at which the document can be split
+        into separately rendered chunks, roughly chunkLines apart.
+
+        A chunk can only start immediately after a blank line, as the
+        processor ignores the look-ahead line when it handles a blank line,
+        and only where the processor state is completely reset, so that a
+        fresh processor would carry on in the same way. The state is found
+        by a pass of KiwiBoundaryFinder over the lines.
+        """
+        if (mode == None):
+            mode = self.detectMode(lines)
+        return KiwiBoundaryFinder().execute(lines, chunkLines, mode)
+
+    def mergeChunk(self, output, metadata, headerIndexes, sourceMap = None, lineOffset = 0):
+        """
+        Appends the results of a separately rendered chunk to the output and
+        metadata. Header anchors are numbered across the whole document, so
+        they are re-generated here, and the header tags are corrected if the
+        chunk generated a different id for them. headerIndexes holds the
+        output index and the column of the tag of each of the chunk's
+        headers, so that the tag is corrected where it is, even if a compact
+        line holds several headers. The line numbers in the chunk's source
+        map are relative to lineOffset.
+        """
+        if sourceMap is not None:
+            sourceMap = [(first + lineOffset, last + lineOffset) for first, last in sourceMap]
+        offset = len(self.output)
+        # The change in length of each line as the ids are corrected
+        shifts = {}
+        if self.compact and self.output and output:
+            # The chunks start and end outside of any section, so the
+            # serial rendering would have joined these two lines
+            offset -= 1
+            shifts[0] = len(self.output[-1])
+            self.output[-1] += output[0]
+            output = output[1:]
+            if sourceMap is not None:
+                self.sourceMap[-1] = (self.sourceMap[-1][0], sourceMap[0][1])
+                sourceMap = sourceMap[1:]
+        self.output.extend(output)
+        if sourceMap is not None:
+            self.sourceMap.extend(sourceMap)
+        # Text before the first header of the chunk belongs to the last
+        # header of the previous chunks
+        anchors = {"": ""}
+        if self.metadata.headers:
+            anchors[""] = self.metadata.headers[-1]["anchor"]
+        for header, (index, column) in zip(metadata.headers, headerIndexes):
+            anchor = self.metadata.addHeader(header["level"], header["text"])
+            anchors[header["anchor"]] = anchor
+            column += shifts.get(index, 0)
+            if self.headerIds and anchor != header["anchor"]:
+                line = self.output[offset + index]
+                tag = "<h%d id='%s'>" % (header["level"], header["anchor"])
+                self.output[offset + index] = "%s<h%d id='%s'>%s" % (
+                    line[:column], header["level"], anchor, line[column + len(tag):])
+                shifts[index] = shifts.get(index, 0) + len(anchor) - len(header["anchor"])
+            self.headerIndexes.append((offset + index, column))
+        self.metadata.text.extend([(anchors[anchor], text) for anchor, text in metadata.text])
+        self.metadata.links.extend(metadata.links)
+        self.metadata.images.extend(metadata.images)
+        self.metadata.footnoteRefs.extend(metadata.footnoteRefs)
+        self.metadata.footnoteTargets.extend(metadata.footnoteTargets)
+
+    def executeBytes(self, data, mode = None, encoding = "utf-8"):
+        """
+        Bytes-in/bytes-out version of execute(). The data parameter should
+        be the raw contents of a file, and the HTML is returned as bytes in
+        the same encoding, ready to be written out. KiwiMarkup.output holds
+        the lines as usual.
+
+        The result is identical to reading the file in text mode, calling
+        execute() and encoding the joined output, but the whole document is
+        decoded and encoded in one step each, rather than line by line
+        through the text I/O layer. For ASCII-dominant documents both steps
+        are little more than a copy.
+        """
+        self.execute(self.splitLines(data.decode(encoding)), mode)
+        return "\n".join(self.output).encode(encoding)
+
+    @staticmethod
+    def splitLines(text):
+        """
+        Splits text into lines in the same way as universal newlines mode
+        would, without the line endings.
+        """
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        lines = text.split("\n")
+        if lines[-1] == "":
+            lines.pop()
+        return lines
+
+    def renderMany(self, snippets, mode = None, workers = 1, minParallel = 2000):
+        """
+        Renders a sequence of small, independent documents, given as text,
+        and returns a list of the HTML for each (an empty string for an
+        empty document). This instance, with its compiled patterns, is used
+        for every document, and its state is reset before each one, so the
+        cost of each is little more than processing its lines.
+
+        If workers is more than 1 (or None, to use all the CPUs) and there
+        are at least minParallel snippets, they are split between a pool of
+        worker processes.
+        """
+        snippets = list(snippets)
+        workers = workers or os.cpu_count() or 1
+        if workers > 1 and len(snippets) >= minParallel:
+            # Several batches for each worker, to even out the load
+            size = -(-len(snippets) // (workers * 4))
+            tasks = [(snippets[start:start + size], mode, self.options())
+                     for start in range(0, len(snippets), size)]
+            results = []
+            with ProcessPoolExecutor(max_workers = workers) as executor:
+                for batch in executor.map(_renderSnippets, tasks):
+                    results.extend(batch)
+            return results
+
+        results = []
+        for snippet in snippets:
+            lines = self.splitLines(snippet)
+            if lines:
+                self.execute(lines, mode)
+                results.append("\n".join(self.output))
+            else:
+                results.append("")
+        return results
+
+    def emit(self, fragment, isText = False):
+        """
+        Adds a fragment of HTML to the output. In compact mode fragments are
+        joined onto the current line, except inside PRE blocks and code
+        sections, and between consecutive lines of text, where the newline
+        is significant.
+        """
+        if not self.compact:
+            self.output.append(fragment)
+            if self.sourceMap is not None:
+                self.sourceMap.append(self.sourceRange)
+        else:
+            if self.state.inBlock or self.state.inCodeSection or (isText and self.pendingText):
+                self.flushPending()
+            if not self.pending:
+                self.pendingRange = self.sourceRange
+            else:
+                self.pendingRange = (self.pendingRange[0], self.sourceRange[1])
+            self.pending.append(fragment)
+            self.pendingText = isText
+
+    def flushPending(self):
+        """
+        Moves the current line of joined fragments (compact mode only) to
+        the output.
+        """
+        if self.pending:
+            self.output.append("".join(self.pending))
+            if self.sourceMap is not None:
+                self.sourceMap.append(self.pendingRange)
+            self.pending = []
+
     def startParagraph(self):
         """
         Starts a new <p> section, provided there is not one already open.
         """
         if not self.state.inParagraph:
-            self.output.append('<p>')
+            self.emit('<p>')
             self.state.inParagraph = True
 
     def endParagraph(self):
@@ -183,7 +602,7 @@ class KiwiMarkup:
         Ends a current <p> section. If no paragraph is open, does nothing.
         """
         if self.state.inParagraph:
-            self.output.append('</p>')
+            self.emit('</p>')
             self.state.inParagraph = False
 
     def startBlock(self):
@@ -192,7 +611,7 @@ class KiwiMarkup:
         if the block is already open.
         """
         if not self.state.inBlock:
-            self.output.append('<pre>')
+            self.emit('<pre>')
             self.state.inBlock = True
 
     def endBlock(self):
@@ -200,7 +619,7 @@ class KiwiMarkup:
         Ends any current 'PRE' block. If no block is open, does nothing.
         """
         if self.state.inBlock:
-            self.output.append('</pre>')
+            self.emit('</pre>')
             self.state.inBlock = False
 
     def listIndent(self, increment = 0):
@@ -212,6 +631,8 @@ class KiwiMarkup:
         The 'increment' parameter allows items to be indented on step further,
         so that LI tags can be indented more deeply than the UL tags
         """
+        if self.compact:
+            return ""
         return "    " * (len(self.indents) - 1 + increment)
 
     def startList(self):
@@ -241,9 +662,9 @@ class KiwiMarkup:
             # If a sub-list is being started, indent the tag
             # by an extra amount
             if nested:
-                self.output.append('%s<ul>' % self.listIndent(1))
+                self.emit('%s<ul>' % self.listIndent(1))
             else:
-                self.output.append('%s<ul>' % self.listIndent())
+                self.emit('%s<ul>' % self.listIndent())
             self.state.inList = True
 
     def endNestedList(self):
@@ -255,8 +676,8 @@ class KiwiMarkup:
             indent = self.indents[-1]
             if self.line.listIndent < indent:
                 # Close the list and the LI tag
-                self.output.append('%s</ul>' % self.listIndent(1))
-                self.output.append('%s</li>' % self.listIndent())
+                self.emit('%s</ul>' % self.listIndent(1))
+                self.emit('%s</li>' % self.listIndent())
                 self.indents.pop()
                 # It's possible that the current line is actually
                 # ending more than one list, so recursively call
@@ -273,7 +694,7 @@ class KiwiMarkup:
             if len(self.indents) > 0:
                 self.endNestedList()
             if len(self.indents) == 0:
-                self.output.append('%s</ul>' % self.listIndent())
+                self.emit('%s</ul>' % self.listIndent())
                 self.state.inList = False
 
     def endAllLists(self):
@@ -282,8 +703,8 @@ class KiwiMarkup:
         list, if any.
         """
         while len(self.indents) > 0:
-            self.output.append('%s</ul>' % self.listIndent(1))
-            self.output.append('%s</li>' % self.listIndent())
+            self.emit('%s</ul>' % self.listIndent(1))
+            self.emit('%s</li>' % self.listIndent())
             self.indents.pop()
         self.endList()
 
@@ -292,7 +713,7 @@ class KiwiMarkup:
         Starts a new table ('<TABLE>'). If one is already open, does nothing.
         """
         if not self.state.inTable:
-            self.output.append('<table>')
+            self.emit('<table>')
             self.state.inTable = True
 
     def endTable(self):
@@ -300,7 +721,7 @@ class KiwiMarkup:
         Ends any open table. If no table is open, does nothing.
         """
         if self.state.inTable:
-            self.output.append('</table>')
+            self.emit('</table>')
             self.state.inTable = False
 
     def startOrgSection(self):
@@ -310,16 +731,22 @@ class KiwiMarkup:
         one '<p>' tag, separated by line-break ('<br>') tags.
         """
         if not self.state.inOrgSection:
-            self.output.append('<p>')
+            self.emit('<p>')
             self.state.inOrgSection = True
 
-    def startCodeSection(self):
+    def startCodeSection(self, language = ""):
         """
-        Starts a block of text that should be formatted as code
+        Starts a block of text that should be formatted as code. If the code
+        is to be highlighted, the lines are held back until the end of the
+        section, so that the block can be highlighted as a whole.
         """
         if not self.state.inCodeSection:
-            self.output.append('<pre>')
-            self.output.append('<code>')
+            self.emit('<pre>')
+            if self.highlighter and language:
+                self.emit("<code class='language-%s'>" % escape(language))
+                self.codeLanguage = language
+            else:
+                self.emit('<code>')
             self.state.inCodeSection = True
 
     def endCodeSection(self):
@@ -327,10 +754,28 @@ class KiwiMarkup:
         Ends a block of code
         """
         if self.state.inCodeSection:
-            self.output.append('</code>')
-            self.output.append('</pre>')
+            self.flushCodeLines()
+            self.emit('</code>')
             self.state.inCodeSection = False
-            
+            self.emit('</pre>')
+
+    def flushCodeLines(self):
+        """
+        Outputs the lines of a code section which is being highlighted.
+        """
+        if self.codeLines:
+            lines = self.highlighter.highlight(self.codeLanguage, "\n".join(self.codeLines))
+            if lines is None or len(lines) != len(self.codeLines):
+                lines = [escape(line, False) for line in self.codeLines]
+            sourceRange = self.sourceRange
+            for line, lineNumber in zip(lines, self.codeLineNumbers):
+                self.sourceRange = (lineNumber, lineNumber)
+                self.emit(line)
+            self.sourceRange = sourceRange
+            self.codeLines = []
+            self.codeLineNumbers = []
+        self.codeLanguage = ""
+
     def endAllSections(self):
         """
         Closes any/all open tags
@@ -362,7 +807,7 @@ class KiwiMarkup:
         else:
             return None
 
-    def re_sub(self, pattern, replacement, string):
+    def re_sub(self, pattern, replacement, string, collect = None):
         """
         Work-around for re.sub unmatched group error.
 
@@ -371,6 +816,9 @@ class KiwiMarkup:
         external dependencies if at all possible.
 
         See https://gist.github.com/gromgull/3922244
+
+        If collect is supplied, each match is passed to it before the
+        replacement is made.
         """
         def _r(m):
             # Now this is ugly.
@@ -390,27 +838,58 @@ class KiwiMarkup:
                 def group(self, n):
                     return m.group(n) or ""
 
+            if collect:
+                collect(m)
             return re._expand(pattern, _m(m), replacement)
 
-        return re.sub(pattern, _r, string)
+        return pattern.sub(_r, string)
+
+    def collectSub(self, pattern, replacement, string, collect):
+        """
+        Equivalent to pattern.sub(replacement, string), but each match is
+        first passed to the collect function, so that the metadata can be
+        gathered in the same pass that generates the HTML.
+        """
+        def _r(m):
+            collect(m)
+            return m.expand(replacement)
+
+        return pattern.sub(_r, string)
+
+    def collectImage(self, src, alt):
+        self.metadata.images.append({"src": src, "alt": alt})
+
+    def collectLink(self, href, text):
+        self.metadata.links.append({"href": href, "text": text})
 
     def applyInlineMarkup(self, line):
         """
         Applies markup to the supplied line and returns the results. It
         assumes the self.line holds the additional details for the line.
         """
-        line = self.boldStartPattern.sub(r"\1<b>\3", line)
-        line = self.boldEndPattern.sub(r"\1</b>\3", line)
-        line = self.emphStartPattern.sub(r"\1<i>\3", line)
-        line = self.emphEndPattern.sub(r"\1</i>\3", line)
-        line = self.mdImgPattern.sub(r"<img src='\2' alt='\1' title='\1'/>", line)
-        line = self.re_sub(self.imgPattern, r"<img src='\7' class='\3' alt='\6' title='\6'/>", line)
-        line = self.re_sub(self.audioPattern, r"<audio width='300px' height='32px' src='\7' class='\3' controls='controls'> Your browser does not support audio playback. </audio>", line)
-        line = self.re_sub(self.linkPattern, r"<a href='\7' class='\3' alt='\6'>\6</a>", line)
-        line = self.mdUrlPattern.sub(r"<a href='\2'>\1</a>", line)
-        line = self.orgmodeUrlPattern.sub(r"<a href='\1'>\2</a>", line)
-        line = self.footnoteTargetPattern.sub(r"\1. <a name='footnote_target_\1' href='#footnote_ref_\1'>&#160;&#8617;</a>", line)
-        line = self.footnotePattern.sub(r"<a name='footnote_ref_\1' href='#footnote_target_\1'>[<sup>\1</sup>]</a>", line)
+        # Skip the patterns which cannot match, as most lines have no markup
+        if "**" in line:
+            line = self.boldStartPattern.sub(r"\1<b>\3", line)
+            line = self.boldEndPattern.sub(r"\1</b>\3", line)
+        if "_" in line:
+            line = self.emphStartPattern.sub(r"\1<i>\3", line)
+            line = self.emphEndPattern.sub(r"\1</i>\3", line)
+        if "[" in line:
+            line = self.collectSub(self.mdImgPattern, r"<img src='\2' alt='\1' title='\1'/>", line,
+                                   lambda m: self.collectImage(m.group(2), m.group(1)))
+            line = self.re_sub(self.imgPattern, r"<img src='\7' class='\3' alt='\6' title='\6'/>", line,
+                               lambda m: self.collectImage(m.group(7), m.group(6) or ""))
+            line = self.re_sub(self.audioPattern, r"<audio width='300px' height='32px' src='\7' class='\3' controls='controls'> Your browser does not support audio playback. </audio>", line)
+            line = self.re_sub(self.linkPattern, r"<a href='\7' class='\3' alt='\6'>\6</a>", line,
+                               lambda m: self.collectLink(m.group(7), m.group(6) or ""))
+            line = self.collectSub(self.mdUrlPattern, r"<a href='\2'>\1</a>", line,
+                                   lambda m: self.collectLink(m.group(2), m.group(1)))
+            line = self.collectSub(self.orgmodeUrlPattern, r"<a href='\1'>\2</a>", line,
+                                   lambda m: self.collectLink(m.group(1), m.group(2)))
+            line = self.collectSub(self.footnoteTargetPattern, r"\1. <a name='footnote_target_\1' href='#footnote_ref_\1'>&#160;&#8617;</a>", line,
+                                   lambda m: self.metadata.footnoteTargets.append(m.group(1)))
+            line = self.collectSub(self.footnotePattern, r"<a name='footnote_ref_\1' href='#footnote_target_\1'>[<sup>\1</sup>]</a>", line,
+                                   lambda m: self.metadata.footnoteRefs.append(m.group(1)))
         return line
         
     def processLine(self):
@@ -419,14 +898,20 @@ class KiwiMarkup:
         HTML.
         """
         includeLine = True;
+        isHeader = False
         if (self.thisLine != None):
             # Scan the line to get the details for it, then carry out the
             # appropriate actions, based on the line type
             self.line.scan(self.thisLine, self.nextLine, self.state)
+            if self.line.skipNextLine:
+                # The header underline or table divider belongs to this line
+                self.sourceRange = (self.lineNumber, self.lineNumber + 1)
+            else:
+                self.sourceRange = (self.lineNumber, self.lineNumber)
 
             if self.line.isCodeStart:
                 self.endAllSections()
-                self.startCodeSection()
+                self.startCodeSection(self.line.codeLanguage)
                 includeLine = False
 
             elif self.line.isCodeEnd:
@@ -455,19 +940,21 @@ class KiwiMarkup:
                 self.endAllLists()
                 self.endParagraph()
                 self.startTable()
-                self.output.append("    <tr>")
+                self.emit(self.rowStart)
                 for column in self.line.tableColumns:
                     column = self.applyInlineMarkup(column)
                     if self.line.isTableHeader:
-                        self.output.append("        <th>%s</th>" % column)
+                        self.emit(self.headerCell % column)
                     else:
-                        self.output.append("        <td>%s</td>" % column)
-                self.output.append("    </tr>")
+                        self.emit(self.cell % column)
+                self.emit(self.rowEnd)
                 includeLine = False
 
             elif self.line.isHeader:
                 self.endAllSections()
                 self.thisLine = "<h%d>%s</h%d>" %(self.line.headerLevel, self.line.headerText, self.line.headerLevel)
+                # The header is recorded once the inline markup is applied
+                isHeader = True
 
             elif self.line.isHorizontalLine:
                 self.endAllSections()
@@ -489,15 +976,194 @@ class KiwiMarkup:
             if includeLine:
                 if not self.state.inBlock and not self.state.inCodeSection:
                     self.thisLine = self.applyInlineMarkup(self.thisLine)
+                    if isHeader:
+                        # The anchor is made from the text as it is displayed
+                        level = self.line.headerLevel
+                        anchor = self.metadata.addHeader(level, KiwiMetadata.plainText(self.thisLine))
+                        # In compact mode the tag is joined onto the pending line
+                        column = sum(len(fragment) for fragment in self.pending)
+                        self.headerIndexes.append((len(self.output), column))
+                        if self.headerIds:
+                            self.thisLine = self.thisLine.replace("<h%d>" % level, "<h%d id='%s'>" % (level, anchor), 1)
+                    if self.collectText and (self.line.isParagraph or self.line.isList or self.line.isHeader):
+                        self.metadata.addText(self.thisLine)
+                elif self.codeLanguage:
+                    # Highlighted code is output at the end of the section
+                    self.codeLines.append(self.thisLine[4:])
+                    self.codeLineNumbers.append(self.lineNumber)
+                    return
                 else:
                     self.thisLine = self.thisLine[4:]
-                    self.thisLine = cgi.escape(self.thisLine)
-                self.output.append(self.thisLine)
+                    self.thisLine = escape(self.thisLine, False)
+                self.emit(self.thisLine, self.line.isParagraph)
+
+def _executeChunk(task):
+    """
+    Worker for KiwiMarkup.executeParallel(). Renders one chunk of a document
+    and returns the results.
+    """
+    lines, mode, options = task
+    kiwi = KiwiMarkup(**options)
+    kiwi.execute(lines, mode)
+    return (kiwi.output, kiwi.metadata, kiwi.headerIndexes, kiwi.sourceMap)
+
+def _renderSnippets(task):
+    """
+    Worker for KiwiMarkup.renderMany(). Renders a batch of snippets.
+    """
+    snippets, mode, options = task
+    return KiwiMarkup(**options).renderMany(snippets, mode)
+
+class KiwiExcerpt(KiwiMarkup):
+    """
+    Extracts the title and the opening paragraphs of a document, for index
+    pages, reading only as many lines as it needs. The lines are processed
+    by the same rules as KiwiMarkup.execute(), so the paragraphs are exactly
+    as they appear in the full render (with the same options), but reading
+    stops as soon as the first header and enough paragraphs have been seen.
+    lines may be any iterable, such as an open file.
+
+    Reading stops after the given number of paragraphs, or once the
+    paragraphs hold at least the given number of characters of text,
+    whichever comes first (pass None to ignore either limit). On return
+    KiwiExcerpt.title and KiwiExcerpt.level hold the text and level of the
+    first header (or None if there are no headers, in which case the whole
+    document is read), KiwiExcerpt.paragraphs holds the HTML of each
+    paragraph and KiwiExcerpt.text holds their text, without tags, cut to
+    the number of characters.
+    """
+
+    def __init__(self, paragraphs = 1, characters = None, **options):
+        KiwiMarkup.__init__(self, **options)
+        self.maxParagraphs = paragraphs
+        self.maxCharacters = characters
+        self.capture = None
+
+    def execute(self, lines, mode = None):
+        self.title = None
+        self.level = None
+        self.paragraphs = []
+        self.texts = []
+        self.characterCount = 0
+
+        lines = iter(lines)
+        for first in lines:
+            if mode is None:
+                mode = self.detectMode([first])
+            self.start(mode)
+            self.feed([first])
+            break
+        else:
+            self.text = ""
+            return False
+
+        for line in lines:
+            self.feed([line])
+            if self.isComplete():
+                break
+        else:
+            self.finish()
+
+        self.text = " ".join(self.texts)
+        if self.maxCharacters is not None:
+            self.text = self.text[:self.maxCharacters]
+        return len(self.paragraphs) > 0 or self.title is not None
+
+    def needsParagraphs(self):
+        """
+        Returns True until enough paragraphs have been found.
+        """
+        return ((self.maxParagraphs is None or len(self.paragraphs) < self.maxParagraphs) and
+                (self.maxCharacters is None or self.characterCount < self.maxCharacters))
+
+    def isComplete(self):
+        """
+        Returns True once the title and enough paragraphs have been found.
+        """
+        return self.title is not None and not self.needsParagraphs()
+
+    def processLine(self):
+        KiwiMarkup.processLine(self)
+        if self.title is None and self.metadata.headers:
+            header = self.metadata.headers[0]
+            self.title = header["text"]
+            self.level = header["level"]
+
+    def emit(self, fragment, isText = False):
+        if self.capture is not None:
+            self.capture.append((fragment, isText))
+        KiwiMarkup.emit(self, fragment, isText)
+
+    def startParagraph(self):
+        if not self.state.inParagraph:
+            self.capture = []
+        KiwiMarkup.startParagraph(self)
+
+    def endParagraph(self):
+        if self.state.inParagraph:
+            KiwiMarkup.endParagraph(self)
+            if self.compact:
+                # Consecutive lines of text are kept on separate lines, as
+                # they are by emit()
+                html = self.capture[0][0]
+                for index in range(1, len(self.capture)):
+                    if self.capture[index][1] and self.capture[index - 1][1]:
+                        html += "\n"
+                    html += self.capture[index][0]
+            else:
+                html = "\n".join(fragment for fragment, isText in self.capture)
+            self.capture = None
+            if self.needsParagraphs():
+                text = KiwiMetadata.plainText(html).split()
+                self.paragraphs.append(html)
+                self.texts.append(" ".join(text))
+                self.characterCount += len(self.texts[-1])
+
+class KiwiBoundaryFinder(KiwiMarkup):
+    """
+    Finds the points at which a document can be split for
+    KiwiMarkup.executeParallel(). The lines are processed by the same rules
+    as KiwiMarkup.execute(), so that the state is exactly as it would be in
+    the full render, but no output is generated and the inline markup is
+    not applied.
+    """
+
+    def execute(self, lines, chunkLines, mode = KIWI_MODE_STD):
+        """
+        Returns the indexes of the lines, roughly chunkLines apart, which
+        follow a blank line and before which every section is closed.
+        """
+        boundaries = []
+        nextBoundary = chunkLines
+        self.start(mode)
+        for index, line in enumerate(lines):
+            # Feeding a line processes the line before it
+            self.feed([line])
+            if (index >= nextBoundary and self.isReset() and
+                    lines[index - 1].strip() == "" and line.strip() != ""):
+                boundaries.append(index)
+                nextBoundary = index + chunkLines
+        return boundaries
+
+    def isReset(self):
+        """
+        Returns True if the processor is in the same state as a new one.
+        """
+        return (not any(getattr(self.state, flag) for flag in KiwiState.FLAGS) and
+                not self.indents and not self.line.skipNextLine and not self.pendingText)
+
+    def emit(self, fragment, isText = False):
+        self.pendingText = isText
+
+    def applyInlineMarkup(self, line):
+        return line
 
 class KiwiState:
     """
     Simple class to hold the current state of the processor
     """
+    FLAGS = ("inBold", "inItalic", "inParagraph", "inTable", "inList", "inBlock", "inCodeSection")
+
     inBold = False
     inItalic = False
     inParagraph = False
@@ -506,6 +1172,210 @@ class KiwiState:
     inBlock = False
     inCodeSection = False
 
+class KiwiMetadata:
+    """
+    Holds the details which are collected while the lines are processed:
+
+    headers         - a list of {"level", "text", "anchor"} entries
+    links           - a list of {"href", "text"} entries
+    images          - a list of {"src", "alt"} entries
+    footnoteRefs    - the footnote numbers referenced by [^n] markup
+    footnoteTargets - the footnote numbers defined by [^n]: markup
+    text            - a list of (anchor, text) entries, holding the plain
+                      text of each header, paragraph line and list item,
+                      and the anchor of the header it comes under ("" for
+                      text before the first header). This is only collected
+                      if KiwiMarkup.collectText is True.
+    """
+
+    tagPattern = re.compile(r"<[^>]*>")
+
+    def __init__(self):
+        self.headers = []
+        self.text = []
+        self.links = []
+        self.images = []
+        self.footnoteRefs = []
+        self.footnoteTargets = []
+        self.anchors = set()
+        self.anchorCounts = {}
+        self.sectionAnchor = ""
+
+    def makeAnchor(self, text):
+        """
+        Returns a unique anchor id for the header text. Repeated headers get
+        a numeric suffix, in the same way as GitHub does it, so the ids are
+        stable as long as the document above them does not change.
+        """
+        base = re.sub(r"[\W_]+", "-", text.lower()).strip("-") or "section"
+        count = self.anchorCounts.get(base, 0)
+        anchor = base if count == 0 else "%s-%d" % (base, count)
+        while anchor in self.anchors:
+            count += 1
+            anchor = "%s-%d" % (base, count)
+        self.anchorCounts[base] = count + 1
+        self.anchors.add(anchor)
+        return anchor
+
+    def addText(self, html):
+        """
+        Records the text of a line of HTML, with the markup removed.
+        """
+        text = self.plainText(html)
+        if text:
+            self.text.append((self.sectionAnchor, text))
+
+    @classmethod
+    def plainText(cls, html):
+        """
+        Returns the text of a line of HTML, with the markup removed.
+        """
+        return unescape(cls.tagPattern.sub("", html)).strip()
+
+    def addHeader(self, level, text):
+        """
+        Records a header and returns the anchor id which was generated for it.
+        The text should be plain text, as it is displayed.
+        """
+        text = text.strip()
+        anchor = self.makeAnchor(text)
+        self.headers.append({"level": level, "text": text, "anchor": anchor})
+        self.sectionAnchor = anchor
+        return anchor
+
+class KiwiHighlighter:
+    """
+    Syntax highlighter for code sections. If Pygments is installed it is
+    used for any language it knows, otherwise a simple built-in tokenizer
+    handles a few common languages. Either way the tokens are wrapped in
+    <span> tags using the Pygments CSS class names, so the same stylesheet
+    works for both.
+
+    Highlighting is slow compared to the rest of the processing, so the
+    results are cached, keyed by a hash of the language and the code, and
+    a page which repeats the same listings only highlights them once.
+    """
+
+    # Built-in languages: each entry holds the regex for the comments and
+    # strings, and the keywords.
+    LANGUAGES = {
+        "python": (
+            r"(?P<c>#[^\n]*)"
+            r"|(?P<s>" + '"""' + r"[\s\S]*?" + '"""' + r"|'''[\s\S]*?'''"
+            r"|\"(?:\\.|[^\"\\\n])*\"|'(?:\\.|[^'\\\n])*')",
+            "and as assert async await break class continue def del elif else except "
+            "False finally for from global if import in is lambda None nonlocal not "
+            "or pass raise return True try while with yield"),
+        "javascript": (
+            r"(?P<c>//[^\n]*|/\*[\s\S]*?\*/)"
+            r"|(?P<s>`[^`]*`|\"(?:\\.|[^\"\\\n])*\"|'(?:\\.|[^'\\\n])*')",
+            "async await break case catch class const continue debugger default delete "
+            "do else export extends false finally for function if import in instanceof "
+            "let new null return super switch this throw true try typeof undefined var "
+            "void while with yield"),
+        "c": (
+            r"(?P<c>//[^\n]*|/\*[\s\S]*?\*/|^[ \t]*#[^\n]*)"
+            r"|(?P<s>\"(?:\\.|[^\"\\\n])*\"|'(?:\\.|[^'\\\n])*')",
+            "auto break case char const continue default do double else enum extern "
+            "float for goto if inline int long register return short signed sizeof "
+            "static struct switch typedef union unsigned void volatile while"),
+        "shell": (
+            r"(?P<c>(?<![\w$])#[^\n]*)"
+            r"|(?P<s>\"(?:\\.|[^\"\\])*\"|'[^']*')",
+            "case do done elif else esac export fi for function if in local return "
+            "select then until while"),
+    }
+
+    ALIASES = {"py": "python", "js": "javascript", "h": "c", "sh": "shell", "bash": "shell"}
+
+    NUMBER_REGEX = r"(?P<m>\b(?:0[xX][0-9a-fA-F]+|[0-9]+(?:\.[0-9]*)?(?:[eE][+-]?[0-9]+)?)\b)"
+
+    NAME_REGEX = r"(?P<name>[A-Za-z_][A-Za-z0-9_]*)"
+
+    sharedInstance = None
+
+    def __init__(self, maxEntries = 1000, usePygments = True):
+        self.maxEntries = maxEntries
+        self.usePygments = usePygments and pygments is not None
+        self.cache = OrderedDict()
+        self.rules = {}
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the highlighter which is shared by all the KiwiMarkup
+        instances in this process, so that they also share its cache.
+        """
+        if cls.sharedInstance is None:
+            cls.sharedInstance = cls()
+        return cls.sharedInstance
+
+    def highlight(self, language, text):
+        """
+        Returns the highlighted HTML for the code as a list of lines, one for
+        each line of the text, or None if the language is not supported.
+        """
+        language = language.lower()
+        key = hashlib.sha1(("%s\n%s" % (language, text)).encode("utf-8")).hexdigest()
+        lines = self.cache.get(key)
+        if lines is not None:
+            self.cache.move_to_end(key)
+            return lines
+        if self.usePygments:
+            lines = self.pygmentsHighlight(language, text)
+        if lines is None:
+            lines = self.builtinHighlight(language, text)
+        if lines is not None:
+            self.cache[key] = lines
+            if len(self.cache) > self.maxEntries:
+                self.cache.popitem(last = False)
+        return lines
+
+    def pygmentsHighlight(self, language, text):
+        try:
+            lexer = pygments.lexers.get_lexer_by_name(language, stripnl = False, ensurenl = True)
+        except pygments.util.ClassNotFound:
+            return None
+        formatter = pygments.formatters.HtmlFormatter(nowrap = True)
+        html = pygments.highlight(text, lexer, formatter)
+        # Only remove the newline which ensurenl added, so that a final blank
+        # line is kept
+        if html.endswith("\n") and not text.endswith("\n"):
+            html = html[:-1]
+        lines = html.split("\n")
+        if len(lines) != text.count("\n") + 1:
+            return None
+        return lines
+
+    def builtinHighlight(self, language, text):
+        language = self.ALIASES.get(language, language)
+        if language not in self.LANGUAGES:
+            return None
+        if language not in self.rules:
+            regex, keywords = self.LANGUAGES[language]
+            pattern = re.compile("|".join([regex, self.NUMBER_REGEX, self.NAME_REGEX]), re.MULTILINE)
+            self.rules[language] = (pattern, frozenset(keywords.split()))
+        pattern, keywords = self.rules[language]
+
+        html = []
+        position = 0
+        for match in pattern.finditer(text):
+            tokenClass = match.lastgroup
+            token = match.group()
+            if tokenClass == "name":
+                if token not in keywords:
+                    continue
+                tokenClass = "k"
+            html.append(escape(text[position:match.start()], False))
+            # Tokens which run over several lines are split, so that every
+            # line of the output is complete in itself.
+            html.append("\n".join(
+                ["<span class='%s'>%s</span>" % (tokenClass, escape(part, False)) if part else ""
+                 for part in token.split("\n")]))
+            position = match.end()
+        html.append(escape(text[position:], False))
+        return "".join(html).split("\n")
+
 class KiwiLineScanner:
     """
     Simple class to scan the current line and store details about it.
@@ -536,6 +1406,9 @@ class KiwiLineScanner:
         self.tableHeaderPattern = re.compile(TABLE_HEADER_REGEX)
         self.codeStartPattern = re.compile(CODEBLOCK_START_REGEX)
         self.codeEndPattern = re.compile(CODEBLOCK_END_REGEX)
+        self.underlinePattern = re.compile(r"^={5,}=+$")
+        self.subUnderlinePattern = re.compile(r"^-{5,}-+$")
+        self.horizontalLinePattern = re.compile(r"^[-]{5}[-]+$")
         self.mode = mode
 
     def reset(self):
@@ -546,6 +1419,7 @@ class KiwiLineScanner:
         self.isTableHeader = False
         self.isBlankLine = False
         self.isBlock = False
+        self.isHorizontalLine = False
         self.isCodeStart = False
         self.isCodeEnd = False
 
@@ -575,7 +1449,7 @@ class KiwiLineScanner:
             self.isParagraph = False
         else:
             if (self.mode == KIWI_MODE_ORG) and (thisLine.strip()[0] == "*"):
-                match = re.search(self.orgHeaderPattern, thisLine)
+                match = self.orgHeaderPattern.search(thisLine)
                 if match:
                     elements = match.groups()
                     header = elements[0]
@@ -596,7 +1470,7 @@ class KiwiLineScanner:
 
     def check_for_header(self, thisLine, nextLine):
         # Check for '#' style of header
-        match = re.search(self.headerPattern, thisLine)
+        match = self.headerPattern.search(thisLine)
         if match:
             self.isParagraph = False
             self.isHeader = True
@@ -606,13 +1480,13 @@ class KiwiLineScanner:
             if (len(elements) > 1):
                 self.headerText = elements[1]
         # Check for 'underline' style of header
-        elif re.search(r"^={5,}=+$", nextLine):
+        elif self.underlinePattern.search(nextLine):
             self.isParagraph = False
             self.isHeader = True
             self.skipNextLine = True
             self.headerLevel = 1
             self.headerText = thisLine
-        elif re.search(r"^-{5,}-+$", nextLine):
+        elif self.subUnderlinePattern.search(nextLine):
             self.isParagraph = False
             self.isHeader = True
             self.skipNextLine = True
@@ -620,7 +1494,7 @@ class KiwiLineScanner:
             self.headerText = thisLine
 
     def check_for_list(self, thisLine, nextLine):
-        match = re.search(self.listPattern, thisLine)
+        match = self.listPattern.search(thisLine)
         if match and not self.state.inBlock:
             self.isParagraph = False
             self.isList = True
@@ -640,7 +1514,7 @@ class KiwiLineScanner:
             # don't close the LI tag on the current line if
             # it is followed by a sublist -- essentially the
             # sub-list in inside LI tag).
-            match = re.search(self.listPattern, nextLine)
+            match = self.listPattern.search(nextLine)
             if match:
                 self.isNestedList = len(match.groups()[0]) > self.listIndent
 
@@ -656,7 +1530,7 @@ class KiwiLineScanner:
         presence of at least two '|' characters in the line, which will also
         be taken as indicating a table.
         """
-        match = re.search(self.tableHeaderPattern, nextLine)
+        match = self.tableHeaderPattern.search(nextLine)
         if match:
             self.isTable = True
             self.isTableHeader = True
@@ -681,31 +1555,1202 @@ class KiwiLineScanner:
         it is preceded by at least one blank line) it will be detected here and
         treated as a horizontal line
         """
-        if re.search(r"^[-]{5}[-]+$", thisLine):
+        if self.horizontalLinePattern.search(thisLine):
             self.isParagraph = False
             self.isHorizontalLine = True
 
     def check_for_code_start(self, thisLine):
-        match = re.search(self.codeStartPattern, thisLine)
+        match = self.codeStartPattern.search(thisLine)
         if match:
             self.isCodeStart = True
             self.codeLanguage = match.group(1)
 
     def check_for_code_end(self, thisLine):
-        match = re.search(self.codeEndPattern, thisLine)
+        match = self.codeEndPattern.search(thisLine)
         if match:
             self.isCodeEnd = True
             self.codeLanguage = ""
 
+class KiwiBuild:
+    """
+    Renders every source file in a folder tree to an HTML fragment, with the
+    same relative path and a '.html' extension, in the target folder. The
+    files are rendered by a pool of worker processes (or in this process if
+    workers is 1), using KiwiMarkup instances created with the given options.
+
+    The target folder holds a manifest (see MANIFEST) recording a hash of
+    each page's output, so that the next build can tell which pages have
+    changed. Pages whose output has not changed are not written again.
+
+    If compress is True, a gzip-compressed copy of each page is written
+    alongside it ('page.html.gz'), ready to be served as-is. The compression
+    is done by the worker which rendered the page, from the output in
+    memory, and is skipped for unchanged pages.
+
+    If searchIndex is True, a static full-text search index is written to
+    the SEARCH_FOLDER of the target folder. pages.json maps the id of each
+    page (see pageIds()) to its URL and title, and the postings for the
+    terms are sharded by the first two characters of the term ('_' if they
+    are not both letters or digits), so 'kiwi' is in 'ki.json'. Each shard
+    maps its terms to a list of [page-id, anchor, anchor...] entries, in
+    the order of the page paths, giving the anchors of the
+    sections of the page which contain the term ("" for the top of the
+    page). The terms are taken from the text of the headers, paragraphs and
+    list items, and are kept in the manifest, so the text of an unchanged
+    page is not tokenized again.
+
+    If imageSizes is True, the width and height of each local image are
+    added to its <img> tags (see KiwiImageSizes). The sizes are cached in
+    the target folder.
+
+    If shard is given, as (index, count), only the source files which
+    shardOf() assigns to that shard (0 to count - 1) are built, so that a
+    large build can be split between processes or machines, each with its
+    own target folder. The manifest records the shard, and the number and a
+    hash of all the source paths, and KiwiShardMerge combines the shard
+    folders into one. The search index is left to the merge.
+    """
+
+    MANIFEST = ".kiwimark-build.json"
+
+    SEARCH_FOLDER = "search"
+
+    MANIFEST_VERSION = 1
+
+    EXTENSIONS = (".txt", ".md", ".org")
+
+    def __init__(self, source, target, workers = None, compress = False, extensions = EXTENSIONS, options = None,
+                 searchIndex = False, imageSizes = False, shard = None):
+        self.source = source
+        self.target = target
+        self.imageSizes = imageSizes
+        self.shard = shard
+        self.workers = workers or os.cpu_count() or 1
+        self.compress = compress
+        self.searchIndex = searchIndex
+        self.extensions = extensions
+        self.options = options or {}
+        self.pages = {}
+
+    def sources(self):
+        """
+        Returns the paths of the source files, relative to the source folder,
+        in a consistent order.
+        """
+        paths = []
+        for folder, folders, files in os.walk(self.source):
+            folders.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1] in self.extensions:
+                    paths.append(os.path.relpath(os.path.join(folder, name), self.source))
+        return paths
+
+    def targetPath(self, path):
+        """
+        Returns the output path for the given relative source path.
+        """
+        return os.path.join(self.target, os.path.splitext(path)[0] + ".html")
+
+    def loadManifest(self):
+        """
+        Returns the manifest of the previous build, or an empty manifest if
+        there is none, or if it was written by an incompatible version.
+        """
+        try:
+            with open(os.path.join(self.target, self.MANIFEST)) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            manifest = {}
+        if manifest.get("version") != self.MANIFEST_VERSION:
+            manifest = {"version": self.MANIFEST_VERSION, "pages": {}}
+        return manifest
+
+    def saveManifest(self, manifest):
+        with open(os.path.join(self.target, self.MANIFEST), "w") as f:
+            json.dump(manifest, f, indent = 1, sort_keys = True)
+
+    def tasks(self, paths, previous):
+        """
+        Returns the worker tasks for the given source paths.
+        """
+        return [(path, os.path.join(self.source, path), self.targetPath(path), self.options,
+                 self.compress, self.searchIndex, previous.get(path)) for path in paths]
+
+    def execute(self):
+        """
+        Builds all the pages. On return KiwiBuild.pages holds the manifest
+        entry for each page, and the return value is the list of the pages
+        which were written because their output changed.
+        """
+        os.makedirs(self.target, exist_ok = True)
+        manifest = self.loadManifest()
+        paths = self.sources()
+        if self.shard:
+            index, count = self.shard
+            if not 0 <= index < count:
+                raise ValueError("Invalid shard %d/%d" % (index, count))
+            manifest["shard"] = {"index": index, "count": count, "total": len(paths),
+                                 "sources": self.sourcesHash(paths)}
+            paths = [path for path in paths if self.shardOf(path, count) == index]
+        else:
+            manifest.pop("shard", None)
+        tasks = self.tasks(paths, manifest["pages"])
+        sizes = None
+        if self.imageSizes:
+            sizes = KiwiImageSizes(self.source, os.path.join(self.target, KiwiImageSizes.CACHE)).execute()
+
+        if self.workers > 1 and len(tasks) > 1:
+            # The image sizes are passed to each worker once, rather than
+            # with every task
+            with ProcessPoolExecutor(max_workers = self.workers, initializer = _setImageSizes,
+                                     initargs = (sizes,)) as executor:
+                results = list(executor.map(_buildPage, tasks, chunksize = 8))
+        else:
+            _setImageSizes(sizes)
+            results = [_buildPage(task) for task in tasks]
+
+        self.pages = dict((path, entry) for path, entry, written in results)
+        # Remove the pages whose source files have gone
+        for path in manifest["pages"]:
+            if path not in self.pages:
+                self.removePage(path)
+        manifest["pages"] = self.pages
+        self.saveManifest(manifest)
+        if self.searchIndex and not self.shard:
+            self.writeSearchIndex()
+        return [path for path, entry, written in results if written]
+
+    def removePage(self, path):
+        """
+        Removes the output of the page for the given relative source path,
+        and its compressed copy.
+        """
+        target = self.targetPath(path)
+        for name in (target, target + ".gz"):
+            if os.path.exists(name):
+                os.remove(name)
+
+    @staticmethod
+    def shardOf(path, count):
+        """
+        Returns the shard (0 to count - 1) which builds the source file at
+        path. This depends only on the relative path, so it is the same on
+        every machine.
+        """
+        digest = hashlib.sha1(path.replace(os.sep, "/").encode("utf-8")).hexdigest()
+        return int(digest[:8], 16) % count
+
+    @staticmethod
+    def sourcesHash(paths):
+        """
+        Returns a hash of the list of source paths, so that shards can check
+        that they were built from the same source tree.
+        """
+        paths = sorted(path.replace(os.sep, "/") for path in paths)
+        return hashlib.sha1("\n".join(paths).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def pageTerms(text):
+        """
+        Returns the search terms for a page, given the (anchor, text) entries
+        from its metadata, as a dictionary of term: [anchors].
+        """
+        terms = {}
+        for anchor, line in text:
+            for term in re.findall(r"\w+", line.lower()):
+                if len(term) > 1:
+                    anchors = terms.setdefault(term, [])
+                    if anchor not in anchors:
+                        anchors.append(anchor)
+        return terms
+
+    @staticmethod
+    def pageIds(urls):
+        """
+        Returns the search index id of each page, by URL. The id is the
+        start of a hash of the URL, so adding or removing a page does not
+        change the ids of the other pages, and only the shards holding its
+        terms change. The ids are lengthened for all the pages in the
+        unlikely event that two of them are the same.
+        """
+        urls = list(urls)
+        length = 8
+        while True:
+            ids = dict((url, hashlib.sha1(url.encode("utf-8")).hexdigest()[:length]) for url in urls)
+            if len(set(ids.values())) == len(ids):
+                return ids
+            length += 2
+
+    @staticmethod
+    def shardName(term):
+        """
+        Returns the name of the search index shard which holds the term.
+        """
+        if re.match(r"[a-z0-9]{2}$", term[:2]):
+            return term[:2]
+        return "_"
+
+    def writeSearchIndex(self):
+        """
+        Writes the search index for all the pages, from the terms held in
+        their manifest entries.
+        """
+        folder = os.path.join(self.target, self.SEARCH_FOLDER)
+        os.makedirs(folder, exist_ok = True)
+        urls = dict((path, os.path.splitext(path)[0].replace(os.sep, "/") + ".html") for path in self.pages)
+        ids = self.pageIds(urls.values())
+        pages = {}
+        shards = {}
+        for path in sorted(self.pages):
+            entry = self.pages[path]
+            pageId = ids[urls[path]]
+            pages[pageId] = {"url": urls[path], "title": entry.get("title", "")}
+            for term, anchors in entry.get("terms", {}).items():
+                shards.setdefault(self.shardName(term), {}).setdefault(term, []).append([pageId] + anchors)
+
+        files = {"pages.json": pages}
+        for name, postings in shards.items():
+            files[name + ".json"] = postings
+        for name, content in files.items():
+            data = json.dumps(content, sort_keys = True, separators = (",", ":")).encode("utf-8")
+            path = os.path.join(folder, name)
+            # Only write the shards which have changed
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    if f.read() == data:
+                        continue
+            with open(path, "wb") as f:
+                f.write(data)
+        for name in os.listdir(folder):
+            if name.endswith(".json") and name not in files:
+                os.remove(os.path.join(folder, name))
+
+class KiwiShardMerge:
+    """
+    Merges the target folders of a sharded KiwiBuild into one target folder.
+    Each page is copied (with its compressed copy, if there is one) unless
+    it is unchanged since the previous merge, and the combined manifest, and
+    the search index if the shards have search terms, are written.
+
+    Before anything is copied, the shard manifests are checked: every shard
+    from 0 to count - 1 must be present exactly once, all the shards must
+    have been built from the same source tree, no page may be built by more
+    than one shard, and every source file must be built by one of them. The
+    output of each page must also match the hash in its manifest. Any
+    problem raises a ValueError listing all the problems.
+    """
+
+    def __init__(self, shards, target):
+        self.shards = shards
+        self.target = target
+        self.pages = {}
+
+    def loadManifests(self):
+        """
+        Returns the manifests of the shards, checking that they form a
+        complete, consistent set.
+        """
+        problems = []
+        manifests = []
+        for folder in self.shards:
+            manifest = KiwiBuild(folder, folder).loadManifest()
+            if "shard" not in manifest:
+                problems.append("%s: not a shard build" % folder)
+            else:
+                manifests.append((folder, manifest))
+        if not manifests:
+            problems.append("no shards to merge")
+        if problems:
+            raise ValueError("\n".join(problems))
+
+        shard = manifests[0][1]["shard"]
+        indexes = sorted(manifest["shard"]["index"] for folder, manifest in manifests)
+        if indexes != list(range(shard["count"])):
+            problems.append("expected shards 0 to %d, found %s" % (shard["count"] - 1, indexes))
+        owners = {}
+        for folder, manifest in manifests:
+            for key in ("count", "total", "sources"):
+                if manifest["shard"][key] != shard[key]:
+                    problems.append("%s: built from a different source tree, or shard count" % folder)
+                    break
+            for path in manifest["pages"]:
+                if path in owners:
+                    problems.append("%s: built by both %s and %s" % (path, owners[path], folder))
+                owners[path] = folder
+        if len(owners) != shard["total"] or KiwiBuild.sourcesHash(owners) != shard["sources"]:
+            problems.append("%d of %d source files were built" % (len(owners), shard["total"]))
+        if problems:
+            raise ValueError("\n".join(problems))
+        return manifests
+
+    def execute(self):
+        """
+        Merges the shards, and returns the list of the pages which were
+        copied because their output changed.
+        """
+        manifests = self.loadManifests()
+        build = KiwiBuild(None, self.target)
+        os.makedirs(self.target, exist_ok = True)
+        merged = build.loadManifest()
+        previous = merged["pages"]
+
+        copies = []
+        problems = []
+        for folder, manifest in manifests:
+            for path, entry in manifest["pages"].items():
+                source = KiwiBuild(folder, folder).targetPath(path)
+                with open(source, "rb") as f:
+                    if hashlib.sha1(f.read()).hexdigest() != entry["output"]:
+                        problems.append("%s: output does not match the manifest of %s" % (path, folder))
+                self.pages[path] = entry
+                target = build.targetPath(path)
+                if (path not in previous or previous[path].get("output") != entry["output"]
+                        or not os.path.exists(target)):
+                    copies.append((path, source, target))
+        if problems:
+            raise ValueError("\n".join(problems))
+
+        for path, source, target in copies:
+            folder = os.path.dirname(target)
+            os.makedirs(folder, exist_ok = True)
+            shutil.copyfile(source, target)
+            if os.path.exists(source + ".gz"):
+                shutil.copyfile(source + ".gz", target + ".gz")
+            elif os.path.exists(target + ".gz"):
+                os.remove(target + ".gz")
+        for path in previous:
+            if path not in self.pages:
+                build.removePage(path)
+
+        merged["pages"] = self.pages
+        build.saveManifest(merged)
+        if any("terms" in entry for entry in self.pages.values()):
+            build.pages = self.pages
+            build.writeSearchIndex()
+        return sorted(path for path, source, target in copies)
+
+# Image sizes for the KiwiBuild workers, set by _setImageSizes()
+_imageSizes = None
+
+def _setImageSizes(sizes):
+    """
+    Initializer for the KiwiBuild workers.
+    """
+    global _imageSizes
+    _imageSizes = sizes
+
+def _buildPage(task):
+    """
+    Worker for KiwiBuild. Renders one source file and writes the output, and
+    the compressed output if required, unless the output is unchanged since
+    the previous build. Returns the path, the manifest entry for the page,
+    and whether the output was written.
+    """
+    path, source, target, options, compress, searchIndex, previous = task
+    with open(source, "rb") as f:
+        data = f.read()
+    kiwi = KiwiMarkup(**dict(options, collectText = searchIndex))
+    html = b""
+    if data:
+        html = kiwi.executeBytes(data)
+        if _imageSizes and b"<img " in html:
+            html = KiwiImageSizes.inject(html, path.replace(os.sep, "/"), _imageSizes)
+    entry = {"output": hashlib.sha1(html).hexdigest(), "title": ""}
+    if data and kiwi.metadata.headers:
+        entry["title"] = kiwi.metadata.headers[0]["text"]
+
+    unchanged = (previous is not None and previous.get("output") == entry["output"]
+                 and os.path.exists(target))
+    if searchIndex:
+        if unchanged and "terms" in previous:
+            entry["terms"] = previous["terms"]
+        else:
+            entry["terms"] = KiwiBuild.pageTerms(kiwi.metadata.text if data else [])
+    written = False
+    if not unchanged:
+        folder = os.path.dirname(target)
+        os.makedirs(folder, exist_ok = True)
+        with open(target, "wb") as f:
+            f.write(html)
+        written = True
+    if compress:
+        if not unchanged or not os.path.exists(target + ".gz"):
+            with open(target + ".gz", "wb") as f:
+                f.write(gzip.compress(html, 9, mtime = 0))
+    elif os.path.exists(target + ".gz"):
+        # Left by an earlier compressed build, and no longer up to date
+        os.remove(target + ".gz")
+    return (path, entry, written)
+
+class KiwiLinkChecker:
+    """
+    Checks the internal links, images and footnotes of every source file in
+    a folder tree, without building it. The files are rendered by a pool of
+    worker processes (or in this process if workers is 1), and the links,
+    images and footnotes are taken from the KiwiMarkup metadata, so that
+    anything inside a code section or a PRE block is ignored, just as it
+    is in the HTML.
+
+    Links with a scheme (such as 'http:' or 'mailto:') and links to an
+    anchor in the same page are not checked. Other links are resolved
+    against the folder of the page, or against the top of the source tree
+    if they start with '/'. A link to 'page.html' is satisfied by a source
+    file which will be built as 'page.html'.
+
+    execute() returns a sorted list of (path, problem, target) tuples, where
+    problem is one of the MISSING_ constants below, or UNREADABLE (with the
+    error as the target) for a file which could not be read or is not valid
+    UTF-8. The other files are still checked.
+    """
+
+    UNREADABLE = "unreadable"
+    MISSING_FILE = "missing file"
+    MISSING_IMAGE = "missing image"
+    MISSING_FOOTNOTE_TARGET = "footnote without target"
+    MISSING_FOOTNOTE_REFERENCE = "footnote target without reference"
+
+    schemePattern = re.compile(r"^([a-zA-Z][a-zA-Z0-9+.-]*:|//)")
+
+    def __init__(self, source, workers = None, extensions = KiwiBuild.EXTENSIONS):
+        self.source = source
+        self.workers = workers or os.cpu_count() or 1
+        self.extensions = extensions
+
+    def files(self):
+        """
+        Returns the set of all the files and folders in the source tree, as
+        relative paths with '/' separators.
+        """
+        files = set()
+        for folder, folders, names in os.walk(self.source):
+            relative = os.path.relpath(folder, self.source).replace(os.sep, "/")
+            if relative == ".":
+                relative = ""
+            for name in folders + names:
+                files.add(posixpath.join(relative, name))
+        return files
+
+    @classmethod
+    def resolve(cls, path, target):
+        """
+        Returns the relative path, with '/' separators, which target refers
+        to when it is used in the page at path, or None if the target is not
+        a local file.
+        """
+        if not target or target.startswith("#") or cls.schemePattern.match(target):
+            return None
+        target = unquote(target.split("#")[0].split("?")[0])
+        if target.startswith("/"):
+            resolved = posixpath.normpath(target.lstrip("/"))
+        else:
+            resolved = posixpath.normpath(posixpath.join(posixpath.dirname(path), target))
+        if resolved == ".":
+            resolved = ""
+        return resolved
+
+    def execute(self):
+        files = self.files()
+        # The pages which the build will produce from the source files
+        pages = set()
+        for name in files:
+            stem, extension = posixpath.splitext(name)
+            if extension in self.extensions:
+                pages.add(stem + ".html")
+
+        paths = sorted(name for name in files if posixpath.splitext(name)[1] in self.extensions
+                       and os.path.isfile(os.path.join(self.source, name)))
+        tasks = [os.path.join(self.source, path) for path in paths]
+        if self.workers > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers = self.workers) as executor:
+                results = list(executor.map(_collectReferences, tasks, chunksize = 64))
+        else:
+            results = [_collectReferences(task) for task in tasks]
+
+        problems = []
+        for path, (links, images, footnoteRefs, footnoteTargets, error) in zip(paths, results):
+            if error is not None:
+                problems.append((path, self.UNREADABLE, error))
+            for link in links:
+                resolved = self.resolve(path, link)
+                if resolved is not None and resolved not in files and resolved not in pages:
+                    problems.append((path, self.MISSING_FILE, link))
+            for image in images:
+                resolved = self.resolve(path, image)
+                if resolved is not None and resolved not in files:
+                    problems.append((path, self.MISSING_IMAGE, image))
+            for footnote in sorted(set(footnoteRefs) - set(footnoteTargets), key = int):
+                problems.append((path, self.MISSING_FOOTNOTE_TARGET, footnote))
+            for footnote in sorted(set(footnoteTargets) - set(footnoteRefs), key = int):
+                problems.append((path, self.MISSING_FOOTNOTE_REFERENCE, footnote))
+        return sorted(problems)
+
+def _collectReferences(source):
+    """
+    Worker for KiwiLinkChecker. Renders one source file and returns the
+    link targets, image sources, footnote references and footnote targets
+    from its metadata, and the error if the file cannot be read (so that one
+    bad file does not stop the whole check).
+    """
+    try:
+        with open(source, "rb") as f:
+            text = f.read().decode("utf-8")
+    except (IOError, UnicodeDecodeError) as e:
+        return ([], [], [], [], str(e))
+    # All of the references need a '[', so most files without one can be
+    # skipped without rendering them
+    if "[" not in text:
+        return ([], [], [], [], None)
+    kiwi = KiwiMarkup()
+    kiwi.execute(KiwiMarkup.splitLines(text))
+    metadata = kiwi.metadata
+    return ([link["href"] for link in metadata.links], [image["src"] for image in metadata.images],
+            metadata.footnoteRefs, metadata.footnoteTargets, None)
+
+class KiwiImageSizes:
+    """
+    Finds the width and height of every PNG, GIF and JPEG image in a folder
+    tree, so that they can be added to the <img> tags of the pages which use
+    them. Only the header of each image is read, and the images are read by
+    a pool of threads. The sizes are cached in a JSON file (if cache is
+    given), by path, file size and modification time, so images which have
+    not changed are not read again.
+
+    execute() returns a dictionary of {path: [width, height]}, where the
+    paths are relative to the source folder, with '/' separators. Images
+    whose size cannot be read are left out.
+    """
+
+    CACHE = ".kiwimark-images.json"
+
+    CACHE_VERSION = 1
+
+    EXTENSIONS = (".png", ".gif", ".jpg", ".jpeg")
+
+    imgPattern = re.compile(br"<img src='([^']*)'")
+
+    def __init__(self, source, cache = None, threads = 8):
+        self.source = source
+        self.cache = cache
+        self.threads = threads
+        self.sizes = {}
+
+    def loadCache(self):
+        try:
+            with open(self.cache) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            cache = {}
+        if cache.get("version") != self.CACHE_VERSION:
+            cache = {"version": self.CACHE_VERSION, "images": {}}
+        return cache
+
+    def saveCache(self, cache):
+        folder = os.path.dirname(self.cache)
+        if folder:
+            os.makedirs(folder, exist_ok = True)
+        with open(self.cache, "w") as f:
+            json.dump(cache, f, indent = 1, sort_keys = True)
+
+    def execute(self):
+        cache = self.loadCache() if self.cache else {"images": {}}
+        previous = cache["images"]
+        images = {}
+        changed = []
+        for folder, folders, names in os.walk(self.source):
+            for name in names:
+                if os.path.splitext(name)[1].lower() not in self.EXTENSIONS:
+                    continue
+                source = os.path.join(folder, name)
+                path = os.path.relpath(source, self.source).replace(os.sep, "/")
+                stat = os.stat(source)
+                entry = previous.get(path)
+                if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+                    images[path] = entry
+                else:
+                    changed.append((path, source, stat))
+
+        if changed:
+            with ThreadPoolExecutor(max_workers = self.threads) as executor:
+                sizes = list(executor.map(self.imageSize, [source for path, source, stat in changed]))
+            for (path, source, stat), size in zip(changed, sizes):
+                images[path] = [stat.st_size, stat.st_mtime_ns] + list(size or (None, None))
+
+        if self.cache and (changed or len(images) != len(previous)):
+            cache["images"] = images
+            self.saveCache(cache)
+        self.sizes = dict((path, entry[2:]) for path, entry in images.items() if entry[2] is not None)
+        return self.sizes
+
+    @staticmethod
+    def imageSize(source):
+        """
+        Returns the (width, height) of a PNG, GIF or JPEG image, read from
+        its header, or None if it is not one of those formats or cannot be
+        read.
+        """
+        try:
+            with open(source, "rb") as f:
+                header = f.read(26)
+                if header[:8] == b"\x89PNG\r\n\x1a\n" and header[12:16] == b"IHDR":
+                    return struct.unpack(">II", header[16:24])
+                if header[:6] in (b"GIF87a", b"GIF89a"):
+                    return struct.unpack("<HH", header[6:10])
+                if header[:2] != b"\xff\xd8":
+                    return None
+                # Walk the JPEG segments until the start of frame, which
+                # holds the size
+                f.seek(2)
+                while True:
+                    marker = f.read(2)
+                    while marker[1:2] == b"\xff":
+                        # Fill bytes
+                        marker = marker[1:] + f.read(1)
+                    if len(marker) < 2 or marker[0:1] != b"\xff":
+                        return None
+                    code = ord(marker[1:2])
+                    if code == 0x01 or 0xd0 <= code <= 0xd7:
+                        continue
+                    length = f.read(2)
+                    if len(length) < 2:
+                        return None
+                    length = struct.unpack(">H", length)[0]
+                    if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+                        frame = f.read(5)
+                        if len(frame) < 5:
+                            return None
+                        height, width = struct.unpack(">HH", frame[1:5])
+                        return (width, height)
+                    f.seek(length - 2, 1)
+        except (IOError, OSError, struct.error):
+            return None
+
+    @classmethod
+    def inject(cls, html, path, sizes):
+        """
+        Adds the width and height to the <img> tags in the HTML (as bytes)
+        of the page at path, for the images found in sizes.
+        """
+        def addSize(match):
+            resolved = KiwiLinkChecker.resolve(path, match.group(1).decode("utf-8"))
+            size = sizes.get(resolved)
+            if size is None:
+                return match.group(0)
+            return match.group(0) + (" width='%d' height='%d'" % tuple(size)).encode("ascii")
+        return cls.imgPattern.sub(addSize, html)
+
+class KiwiRenderCache:
+    """
+    Render cache shared by all the processes on a host, such as the workers
+    of a pre-forking server, held in an SQLite database at path. Rendered
+    pages are keyed by a hash of the document, the mode, the KiwiMarkup
+    options and the source of this module (so a new version of KiwiMarkup
+    does not use old pages). When the pages take up more than maxBytes, the
+    least recently used ones are removed.
+
+    Each thread of each process opens its own connection (again, after a
+    fork), and the database uses write-ahead logging, so readers do not
+    block each other or the writer. A hit is one indexed read, plus a write
+    at most once a minute to mark the page as recently used. The total size
+    of the pages is kept up to date by triggers, so a miss does not need to
+    add up the sizes of all the pages. The cache is only an
+    optimization, so if the database is locked for longer than timeout
+    seconds the page is rendered without it.
+    """
+
+    # How often (in seconds) a page's last use is updated
+    USED_INTERVAL = 60
+
+    moduleHash = None
+
+    def __init__(self, path, maxBytes = 64 * 1024 * 1024, timeout = 5.0):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def __getstate__(self):
+        # The connections are not passed to other processes
+        state = dict(self.__dict__)
+        del state["local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def connection(self):
+        """
+        Returns the connection to the database for this thread and process,
+        creating the database if required.
+        """
+        db = getattr(self.local, "db", None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout = self.timeout, isolation_level = None)
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, html BLOB NOT NULL, "
+                           "size INTEGER NOT NULL, used INTEGER NOT NULL)")
+                db.execute("CREATE INDEX IF NOT EXISTS pagesUsed ON pages (used)")
+                db.execute("CREATE TABLE IF NOT EXISTS total (size INTEGER NOT NULL)")
+                db.execute("INSERT INTO total SELECT TOTAL(size) FROM pages WHERE NOT EXISTS (SELECT * FROM total)")
+                db.execute("CREATE TRIGGER IF NOT EXISTS pagesInsert AFTER INSERT ON pages "
+                           "BEGIN UPDATE total SET size = size + NEW.size; END")
+                db.execute("CREATE TRIGGER IF NOT EXISTS pagesDelete AFTER DELETE ON pages "
+                           "BEGIN UPDATE total SET size = size - OLD.size; END")
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def key(self, data, mode = None, options = None):
+        """
+        Returns the cache key for rendering the document (as bytes) with the
+        given mode and KiwiMarkup options.
+        """
+        if KiwiRenderCache.moduleHash is None:
+            with open(__file__, "rb") as f:
+                KiwiRenderCache.moduleHash = hashlib.sha1(f.read()).hexdigest()
+        settings = json.dumps([self.moduleHash, mode, options or {}], sort_keys = True).encode("utf-8")
+        return hashlib.sha1(settings + b"\0" + data).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached page for the key, or None.
+        """
+        db = self.connection()
+        row = db.execute("SELECT html, used FROM pages WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = int(time.time())
+        if row[1] < now - self.USED_INTERVAL:
+            db.execute("UPDATE pages SET used = ? WHERE key = ?", (now, key))
+        return bytes(row[0])
+
+    def put(self, key, html):
+        """
+        Adds a page to the cache, removing the least recently used pages if
+        the cache is full.
+        """
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # Deleted first, rather than replaced, so that the trigger
+            # subtracts its size
+            db.execute("DELETE FROM pages WHERE key = ?", (key,))
+            db.execute("INSERT INTO pages (key, html, size, used) VALUES (?, ?, ?, ?)",
+                       (key, html, len(html), int(time.time())))
+            excess = db.execute("SELECT size FROM total").fetchone()[0] - self.maxBytes
+            if excess > 0:
+                keys = []
+                for oldKey, size in db.execute("SELECT key, size FROM pages ORDER BY used"):
+                    if excess <= 0:
+                        break
+                    keys.append((oldKey,))
+                    excess -= size
+                db.executemany("DELETE FROM pages WHERE key = ?", keys)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def render(self, data, mode = None, options = None, kiwi = None):
+        """
+        Returns the HTML for the document, as KiwiMarkup.executeBytes()
+        would, from the cache if possible. On a miss the document is
+        rendered with kiwi, or a new KiwiMarkup created with the options.
+        """
+        key = self.key(data, mode, options)
+        try:
+            html = self.get(key)
+        except sqlite3.Error:
+            html = None
+        if html is None:
+            if kiwi is None:
+                kiwi = KiwiMarkup(**(options or {}))
+            html = kiwi.executeBytes(data, mode)
+            try:
+                self.put(key, html)
+            except sqlite3.Error:
+                pass
+        return html
+
+    def clear(self):
+        """
+        Removes all the pages from the cache.
+        """
+        self.connection().execute("DELETE FROM pages")
+
+class KiwiServer:
+    """
+    Render daemon. Listens on a Unix domain socket at path, and renders the
+    documents sent to it by KiwiClient with a pool of worker processes, each
+    of which keeps a warm KiwiMarkup instance for each set of options, so a
+    request costs neither interpreter start-up nor compiling the patterns.
+
+    The protocol is a sequence of frames, each a 4-byte big-endian length
+    followed by that many bytes. A request is two frames: a JSON header
+    ({"mode": ..., "options": {...}}) and the raw document. The response is
+    also two frames: a JSON header ({"error": null} or {"error": message})
+    and the HTML, as returned by KiwiMarkup.executeBytes(). A connection may
+    carry any number of requests, and requests may be pipelined: they are
+    passed to the pool as soon as they arrive, and the responses are sent
+    back in the same order. If a worker process dies, the requests it was
+    handling are answered with {"error": message, "unavailable": true}, so
+    that the client renders them itself, and a new pool is started for the
+    requests which follow.
+
+    If cache is the path of a KiwiRenderCache database, the workers share the
+    pages in it, with each other and with any other process using it.
+    """
+
+    def __init__(self, path, workers = None, cache = None):
+        self.path = path
+        self.workers = workers or os.cpu_count() or 1
+        self.cache = cache
+        self.server = None
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the worker pool and binds the socket, replacing a stale socket
+        left behind by a daemon which is no longer running. Any other kind of
+        file at path is left alone, and a ValueError is raised.
+        """
+        if os.path.lexists(self.path):
+            if not self.isSocket(self.path):
+                raise ValueError("%s exists and is not a socket" % self.path)
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.remove(self.path)
+            else:
+                raise RuntimeError("A daemon is already listening on %s" % self.path)
+            finally:
+                probe.close()
+        self.pool = self.createPool()
+        self.server = socketserver.ThreadingUnixStreamServer(self.path, KiwiRequestHandler)
+        self.server.daemon_threads = True
+        self.server.kiwiServer = self
+
+    @staticmethod
+    def isSocket(path):
+        """
+        Returns True if path is a Unix domain socket (and not a link to one).
+        """
+        try:
+            return stat.S_ISSOCK(os.lstat(path).st_mode)
+        except OSError:
+            return False
+
+    def createPool(self):
+        return ProcessPoolExecutor(self.workers, initializer = _warmRenderer, initargs = (self.cache,))
+
+    def submit(self, task):
+        """
+        Passes a render task to the worker pool, and returns its future. If
+        a worker process has died the pool is broken, so it is replaced.
+        """
+        with self.lock:
+            try:
+                return self.pool.submit(_renderRequest, task)
+            except BrokenProcessPool:
+                self.pool.shutdown(wait = False)
+                self.pool = self.createPool()
+                return self.pool.submit(_renderRequest, task)
+
+    def serve(self):
+        """
+        Starts the daemon, and handles requests until shutdown() is called
+        from another thread, or the process is interrupted.
+        """
+        if not self.server:
+            self.start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        """
+        Stops serve(). Must be called from another thread.
+        """
+        self.server.shutdown()
+
+    def close(self):
+        """
+        Closes the socket and the worker pool.
+        """
+        self.server.server_close()
+        self.pool.shutdown()
+        # Something else may have replaced the socket since it was bound
+        if self.isSocket(self.path):
+            os.remove(self.path)
+
+class KiwiRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handles one KiwiServer connection. This thread reads the requests and
+    passes them to the pool, while a writer thread sends the responses back
+    in order as they are completed.
+    """
+
+    def handle(self):
+        results = queue.Queue()
+        writer = threading.Thread(target = self.writeResponses, args = (results,))
+        writer.start()
+        try:
+            while True:
+                header = _readFrame(self.rfile)
+                data = _readFrame(self.rfile)
+                if header is None or data is None:
+                    break
+                request = json.loads(header.decode("utf-8"))
+                try:
+                    future = self.server.kiwiServer.submit((data, request.get("mode"),
+                                                            request.get("options") or {}))
+                except Exception as e:
+                    future = Future()
+                    future.set_exception(e)
+                results.put(future)
+        finally:
+            results.put(None)
+            writer.join()
+
+    def writeResponses(self, results):
+        while True:
+            future = results.get()
+            if future is None:
+                break
+            try:
+                error, html = future.result()
+                response = {"error": error}
+            except Exception as e:
+                # The worker process died, or the pool could not be started
+                response = {"error": "%s: %s" % (type(e).__name__, e), "unavailable": True}
+                html = b""
+            try:
+                _writeFrames(self.request, [json.dumps(response).encode("utf-8"), html])
+            except socket.error:
+                # The client has gone away, but keep draining the queue
+                pass
+
+class KiwiClient:
+    """
+    Client for KiwiServer. If no daemon is listening on path, or the
+    connection fails part way through, or the daemon cannot render a
+    document because a worker process died, the documents are rendered in
+    this process instead, with the same result. KiwiClient.connected is
+    False if the daemon could not be used.
+
+    A document which cannot be rendered raises a ValueError, whichever
+    process rendered it.
+    """
+
+    def __init__(self, path, options = None):
+        self.path = path
+        self.options = options or {}
+        self.connected = None
+
+    def render(self, data, mode = None):
+        """
+        Renders one document, given as bytes, and returns the HTML as bytes.
+        """
+        return self.renderMany([data], mode)[0]
+
+    def renderMany(self, documents, mode = None):
+        """
+        Renders a sequence of documents, given as bytes, and returns a list
+        of the HTML for each. All the requests are sent without waiting for
+        the responses, so the daemon can work on them while they arrive.
+        """
+        documents = list(documents)
+        results = [None] * len(documents)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            self.connected = True
+            self.exchange(sock, documents, mode, results)
+        except (socket.error, EOFError):
+            # No daemon is running, or it stopped part way through
+            self.connected = False
+        finally:
+            sock.close()
+
+        for index, html in enumerate(results):
+            if html is None:
+                results[index] = self.renderLocally(documents[index], mode)
+        return results
+
+    def exchange(self, sock, documents, mode, results):
+        """
+        Sends the documents to the daemon, and fills in the results as the
+        responses arrive. Documents the daemon was unable to render are left
+        as None.
+        """
+        header = json.dumps({"mode": mode, "options": self.options}).encode("utf-8")
+        def sendRequests():
+            try:
+                for data in documents:
+                    _writeFrames(sock, [header, data])
+                sock.shutdown(socket.SHUT_WR)
+            except socket.error:
+                # The reader will find the connection closed
+                pass
+        sender = threading.Thread(target = sendRequests)
+        sender.start()
+
+        stream = sock.makefile("rb")
+        try:
+            for index in range(len(documents)):
+                response = _readFrame(stream)
+                html = _readFrame(stream)
+                if response is None or html is None:
+                    raise EOFError("The daemon closed the connection")
+                response = json.loads(response.decode("utf-8"))
+                if response.get("unavailable"):
+                    continue
+                if response["error"]:
+                    raise ValueError(response["error"])
+                results[index] = html
+        finally:
+            sender.join()
+            stream.close()
+
+    def renderLocally(self, data, mode):
+        """
+        Renders a document in this process, in the same way as the daemon.
+        """
+        error, html = _renderRequest((data, mode, self.options))
+        if error:
+            raise ValueError(error)
+        return html
+
+def _readFrame(stream):
+    """
+    Reads one length-prefixed frame from a file object, and returns it, or
+    None at the end of the stream.
+    """
+    prefix = stream.read(4)
+    if len(prefix) < 4:
+        return None
+    length = struct.unpack(">I", prefix)[0]
+    payload = stream.read(length)
+    if len(payload) < length:
+        return None
+    return payload
+
+def _writeFrames(sock, payloads):
+    """
+    Sends length-prefixed frames on a socket.
+    """
+    sock.sendall(b"".join(struct.pack(">I", len(payload)) + payload for payload in payloads))
+
+# Warm KiwiMarkup instances in a KiwiServer worker process, by options, and
+# the worker's KiwiRenderCache
+_renderers = {}
+_renderCache = None
+
+def _warmRenderer(cache = None):
+    """
+    Initializer for the KiwiServer workers. Opens the render cache, if there
+    is one, and renders a small document, so that the modules are loaded and
+    the patterns compiled before the first request arrives.
+    """
+    global _renderCache
+    if cache:
+        _renderCache = KiwiRenderCache(cache)
+    _renderRequest((b"Title\n=======\n\n* item\n\n**bold** _emph_ [x](y)\n", None, {}))
+
+def _renderRequest(task):
+    """
+    Worker for KiwiServer, also used by KiwiClient to render in-process.
+    Renders one document with a warm KiwiMarkup instance, and returns
+    (error, html).
+    """
+    data, mode, options = task
+    key = json.dumps(options, sort_keys = True)
+    kiwi = _renderers.get(key)
+    try:
+        if kiwi is None:
+            kiwi = _renderers[key] = KiwiMarkup(**options)
+        if _renderCache:
+            return (None, _renderCache.render(data, mode, options, kiwi))
+        return (None, kiwi.executeBytes(data, mode))
+    except Exception as e:
+        return ("%s: %s" % (type(e).__name__, e), b"")
+
 if __name__ == "__main__":
 
-    # For testing purposes only. Pass a file name on the command-line,
-    # and it will be converted to an HTML fragment, which will then be
-    # output.
-    if len(sys.argv) > 1:
-        f = open(sys.argv[1])
-        lines = f.readlines()
+    # Pass a file name on the command-line, and it will be converted to an
+    # HTML fragment, which will then be output. Pass a folder name and a
+    # target folder name to build all the files in the folder.
+    parser = argparse.ArgumentParser(description = "Convert Kiwi mark-up to HTML")
+    parser.add_argument("source", nargs = "?", help = "source file, or folder to build")
+    parser.add_argument("target", nargs = "?", help = "target folder for a build")
+    parser.add_argument("--check", action = "store_true", help = "check the links and footnotes in a folder")
+    parser.add_argument("--workers", type = int, help = "number of worker processes for a build")
+    parser.add_argument("--gzip", action = "store_true", help = "also write compressed copies of the pages")
+    parser.add_argument("--search-index", action = "store_true", help = "also write a static search index")
+    parser.add_argument("--image-sizes", action = "store_true", help = "add image sizes to the img tags")
+    parser.add_argument("--shard", metavar = "I/N", help = "build only shard I (0 to N-1) of N")
+    parser.add_argument("--merge", metavar = "SHARD", nargs = "+",
+                        help = "merge the target folders of a sharded build into the source folder")
+    parser.add_argument("--compact", action = "store_true", help = "leave out pretty-printing whitespace")
+    parser.add_argument("--highlight", action = "store_true", help = "highlight code sections")
+    parser.add_argument("--header-ids", action = "store_true", help = "add anchor ids to headers")
+    parser.add_argument("--serve", metavar = "SOCKET", help = "run a render daemon on a Unix socket")
+    parser.add_argument("--socket", help = "render a file with the daemon on a Unix socket, if it is running")
+    parser.add_argument("--cache", help = "render cache database, shared between processes")
+    args = parser.parse_args()
+
+    options = {"compact": args.compact, "highlight": args.highlight, "headerIds": args.header_ids}
+    if args.serve:
+        # Close the socket and the workers when stopped by a service manager
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            KiwiServer(args.serve, workers = args.workers, cache = args.cache).serve()
+        except KeyboardInterrupt:
+            pass
+    elif not args.source:
+        parser.error("a source file or folder is required")
+    elif args.merge:
+        try:
+            copied = KiwiShardMerge(args.merge, args.source).execute()
+        except ValueError as e:
+            sys.exit(str(e))
+        print("%d shards merged, %d pages copied" % (len(args.merge), len(copied)))
+    elif args.check:
+        problems = KiwiLinkChecker(args.source, workers = args.workers).execute()
+        for path, problem, target in problems:
+            print("%s: %s: %s" % (path, problem, target))
+        sys.exit(1 if problems else 0)
+    elif os.path.isdir(args.source):
+        if not args.target:
+            parser.error("a target folder is required to build a folder")
+        shard = None
+        if args.shard:
+            match = re.match(r"^(\d+)/(\d+)$", args.shard)
+            if not match or not int(match.group(1)) < int(match.group(2)):
+                parser.error("--shard must be I/N, where I is from 0 to N-1")
+            shard = (int(match.group(1)), int(match.group(2)))
+        build = KiwiBuild(args.source, args.target, workers = args.workers, compress = args.gzip, options = options,
+                          searchIndex = args.search_index, imageSizes = args.image_sizes, shard = shard)
+        written = build.execute()
+        print("%d pages, %d written" % (len(build.pages), len(written)))
+    else:
+        f = open(args.source, "rb")
+        data = f.read()
         f.close()
-        kiwi = KiwiMarkup()
-        kiwi.execute(lines)
-        print("\n".join(kiwi.output))
+        if args.socket:
+            html = KiwiClient(args.socket, options).render(data)
+        elif args.cache:
+            html = KiwiRenderCache(args.cache).render(data, options = options)
+        else:
+            html = KiwiMarkup(**options).executeBytes(data)
+        sys.stdout.buffer.write(html + b"\n")
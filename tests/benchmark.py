@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+KiwiMarkup Benchmarks
+
+Run using 'python benchmark.py [copies]'. The copies parameter sets how many
+times the reference document is repeated to build the large test document.
+The other benchmarks use the reference document as a typical page, and 100k
+small snippets.
+"""
+
+# Standard library imports
+
+import imp
+import io
+import os
+import sys
+import tempfile
+import timeit
+
+# Application specific imports
+
+# Because Kiwimark is not installed into the Python library we need to load it
+# manually.
+scriptfile, pathname, description = imp.find_module("kiwimark", ["../kiwimark"])
+try:
+    kiwimark = imp.load_module("kiwimark", scriptfile, pathname, description)
+finally:
+    scriptfile.close()
+
+def best(function, repeat = 3):
+    """ Returns the best time, in seconds, of several runs of function """
+    return min(timeit.repeat(function, number = 1, repeat = repeat))
+
+def report(name, seconds, size):
+    print("%-32s %8.3fs %8.1f MB/s" % (name, seconds, size / seconds / 1000000.0))
+
+def benchmarkBytes(copies):
+    """
+    Compares the text pipeline (text-mode read, execute(), text-mode write)
+    with the bytes pipeline (binary read, executeBytes(), binary write) on a
+    large, mostly ASCII, document.
+    """
+    with open("input.txt", "rb") as f:
+        reference = f.read()
+    # Mostly ASCII, with the occasional non-ASCII line
+    data = (reference + u"Café naïve — résumé\n\n".encode("utf-8")) * copies
+
+    folder = tempfile.mkdtemp()
+    source = os.path.join(folder, "large.txt")
+    target = os.path.join(folder, "large.html")
+    with open(source, "wb") as f:
+        f.write(data)
+
+    def textRead():
+        with io.open(source, "r", encoding = "utf-8") as f:
+            return f.readlines()
+
+    def bytesRead():
+        with open(source, "rb") as f:
+            text = f.read().decode("utf-8")
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        return text.split("\n")
+
+    def textPipeline():
+        api = kiwimark.KiwiMarkup()
+        api.execute(textRead())
+        with io.open(target, "w", encoding = "utf-8") as f:
+            f.write("\n".join(api.output))
+
+    def bytesPipeline():
+        with open(source, "rb") as f:
+            html = kiwimark.KiwiMarkup().executeBytes(f.read())
+        with open(target, "wb") as f:
+            f.write(html)
+
+    print("Document: %d bytes, %d lines" % (len(data), data.count(b"\n")))
+    report("read lines (text mode)", best(textRead), len(data))
+    report("read lines (bytes, one decode)", best(bytesRead), len(data))
+    report("render pipeline (text)", best(textPipeline), len(data))
+    report("render pipeline (bytes)", best(bytesPipeline), len(data))
+
+    os.remove(source)
+    os.remove(target)
+    os.rmdir(folder)
+
+def benchmarkCache(pages = 1000):
+    """
+    Compares rendering typical pages with fetching them from a shared
+    KiwiRenderCache.
+    """
+    with open("input.txt", "rb") as f:
+        reference = f.read()
+    documents = [reference + (u"\nPage %d\n" % number).encode("utf-8") for number in range(pages)]
+
+    folder = tempfile.mkdtemp()
+    cache = kiwimark.KiwiRenderCache(os.path.join(folder, "cache.db"))
+    for document in documents:
+        cache.render(document)
+
+    def render():
+        for document in documents:
+            kiwimark.KiwiMarkup().executeBytes(document)
+
+    def hit():
+        for document in documents:
+            cache.render(document)
+
+    size = sum(len(document) for document in documents)
+    print("Cache: %d pages of %d bytes" % (pages, len(reference)))
+    rendered = best(render)
+    cached = best(hit)
+    report("render", rendered, size)
+    report("cache hit", cached, size)
+    print("%-32s %8.0fx" % ("speed-up", rendered / cached))
+
+    cache.connection().close()
+    for name in os.listdir(folder):
+        os.remove(os.path.join(folder, name))
+    os.rmdir(folder)
+
+def benchmarkSnippets(count = 100000):
+    """
+    Compares rendering many small snippets with a new KiwiMarkup each, and
+    with one call to renderMany().
+    """
+    samples = [u"Thanks, **great** post!", u"See [the docs](http://example.com/docs) first.",
+               u"* one\n* two\n* three", u"Short _note_\nover two lines", u"# Heading\n\nAnd a paragraph."]
+    snippets = [samples[number % len(samples)] + u" %d" % number for number in range(count)]
+    size = sum(len(snippet.encode("utf-8")) for snippet in snippets)
+
+    def separate():
+        for snippet in snippets:
+            api = kiwimark.KiwiMarkup()
+            api.execute(snippet.split(u"\n"))
+            u"\n".join(api.output)
+
+    def batch():
+        kiwimark.KiwiMarkup().renderMany(snippets)
+
+    print("Snippets: %d, %d bytes" % (count, size))
+    separately = best(separate, 1)
+    batched = best(batch, 1)
+    report("new KiwiMarkup for each", separately, size)
+    report("renderMany()", batched, size)
+    print("%-32s %8.1f us" % ("per snippet (renderMany)", batched / count * 1000000.0))
+
+if (__name__ == "__main__"):
+    copies = 2000
+    if len(sys.argv) > 1:
+        copies = int(sys.argv[1])
+    benchmarkBytes(copies)
+    benchmarkCache()
+    benchmarkSnippets()
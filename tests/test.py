@@ -8,8 +8,20 @@ Run using 'python test.py'
 
 # Standard library imports
 
+import gzip
 import imp
+import io
+import json
+import os
+import random
 import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
 
 # Application specific imports
 
@@ -294,7 +306,842 @@ if (__name__ == "__main__"):
             # Simple match
             m = re.search(regex, ":code\n")
             self.assertNotEqual(m, None)
-            
+
+        def testMetadata(self):
+            """ Verify the metadata collected during execute() """
+            lines = [
+                "# Intro",
+                "See [the site](http://example.com) and [[other.html][other]].",
+                "[link.note:Notes](notes.html) with a footnote[^1].",
+                "![A picture](pic.png) [img.left:Alt](graphics/test.png)",
+                "## Intro",
+                "[^1]: The footnote.",
+                "### The **full** [guide](http://example.com/guide.html)",
+            ]
+            self.api.execute(lines)
+            metadata = self.api.metadata
+            self.assertEqual(metadata.headers, [
+                {"level": 1, "text": "Intro", "anchor": "intro"},
+                {"level": 2, "text": "Intro", "anchor": "intro-1"},
+                # The text is as displayed, without the markup
+                {"level": 3, "text": "The full guide", "anchor": "the-full-guide"},
+            ])
+            self.assertEqual([link["href"] for link in metadata.links],
+                             ["http://example.com", "other.html", "notes.html", "http://example.com/guide.html"])
+            self.assertEqual(metadata.images, [
+                {"src": "pic.png", "alt": "A picture"},
+                {"src": "graphics/test.png", "alt": "Alt"},
+            ])
+            self.assertEqual(metadata.footnoteRefs, ["1"])
+            self.assertEqual(metadata.footnoteTargets, ["1"])
+            # By default the header tags are unchanged
+            self.assertEqual(self.api.output[0], "<h1>Intro</h1>")
+
+        def testHeaderIds(self):
+            """ Verify that anchor ids are added to headers on request """
+            api = kiwimark.KiwiMarkup(headerIds = True)
+            api.execute(["# Version 0.9", "Text", "# Version 0.9"])
+            self.assertEqual(api.output[0], "<h1 id='version-0-9'>Version 0.9</h1>")
+            self.assertEqual(api.output[-1], "<h1 id='version-0-9-1'>Version 0.9</h1>")
+
+    class KiwiCompactCase(unittest.TestCase):
+
+        def testListsAndTables(self):
+            """ Verify that tags are not indented or split across lines """
+            lines = ["* One", "    * Two", "* Three", "", "a | b |", "---|---|", "1 | 2 |"]
+            api = kiwimark.KiwiMarkup(compact = True)
+            api.execute(lines)
+            pretty = kiwimark.KiwiMarkup()
+            pretty.execute(lines)
+            self.assertEqual(api.output, ["".join(line.strip() for line in pretty.output)])
+            self.assertTrue(api.output[0].startswith("<ul><li>One<ul><li>Two</li></ul></li>"))
+            self.assertTrue("<table><tr><th>a</th>" in api.output[0])
+
+        def testSignificantNewlines(self):
+            """ Verify that newlines are kept between text lines and in PRE blocks """
+            api = kiwimark.KiwiMarkup(compact = True)
+            api.execute(["# Title", "Line one", "line two", "", "    pre one", "    pre two", "", "Text"])
+            self.assertEqual(api.output, [
+                "<h1>Title</h1><p>Line one",
+                "line two</p><pre>",
+                "pre one",
+                "pre two",
+                "</pre><p>Text</p>"])
+
+        def testParallel(self):
+            """ Verify that compact output is the same when rendered in parallel """
+            with open("input.txt") as f:
+                lines = f.readlines() * 20
+            for options in ({"compact": True}, {"compact": True, "headerIds": True}):
+                serial = kiwimark.KiwiMarkup(**options)
+                serial.execute(lines)
+                parallel = kiwimark.KiwiMarkup(**options)
+                parallel.executeParallel(lines, workers = 2, minChunkLines = 50)
+                self.assertEqual(parallel.output, serial.output)
+
+        def testParallelHeaderIds(self):
+            """ Verify that repeated header ids are corrected on the right tag of a compact line """
+            lines = ["# Notes", "", "a", "", "b", "", "c", "", "# Notes", "# Notes", "", "d", "", "e", ""]
+            serial = kiwimark.KiwiMarkup(compact = True, headerIds = True)
+            serial.execute(lines)
+            parallel = kiwimark.KiwiMarkup(compact = True, headerIds = True)
+            parallel.executeParallel(lines, workers = 2, minChunkLines = 4)
+            self.assertEqual(re.findall("id='([^']*)'", parallel.output[0]), ["notes", "notes-1", "notes-2"])
+            self.assertEqual(parallel.output, serial.output)
+
+    class KiwiHighlighterCase(unittest.TestCase):
+
+        def setUp(self):
+            self.highlighter = kiwimark.KiwiHighlighter(usePygments = False)
+
+        def testBuiltinTokenizer(self):
+            """ Verify the built-in highlighting of keywords, strings and comments """
+            lines = self.highlighter.highlight("py", 'def f():\n    return "<a>" # note')
+            self.assertEqual(lines, [
+                "<span class='k'>def</span> f():",
+                "    <span class='k'>return</span> <span class='s'>\"&lt;a&gt;\"</span> <span class='c'># note</span>"])
+
+        def testMultilineTokens(self):
+            """ Verify that tokens running over several lines are split per line """
+            lines = self.highlighter.highlight("c", "/* one\ntwo */ int x;")
+            self.assertEqual(lines, ["<span class='c'>/* one</span>",
+                                     "<span class='c'>two */</span> <span class='k'>int</span> x;"])
+
+        def testUnsupportedLanguage(self):
+            """ Verify that unknown languages are not highlighted """
+            self.assertEqual(self.highlighter.highlight("cobol", "MOVE A TO B"), None)
+
+        def testCache(self):
+            """ Verify that repeated blocks are only highlighted once """
+            first = self.highlighter.highlight("python", "x = 1")
+            self.assertTrue(self.highlighter.highlight("python", "x = 1") is first)
+            self.highlighter.highlight("javascript", "x = 1")
+            self.assertEqual(len(self.highlighter.cache), 2)
+
+        def testCodeSections(self):
+            """ Verify that code sections are only highlighted on request """
+            lines = ["code:python", "    pass", ":code", "code:", "    <pass>", ":code"]
+            api = kiwimark.KiwiMarkup()
+            api.execute(lines)
+            self.assertEqual(api.output[1], "<code>")
+            self.assertEqual(api.output[2], "pass")
+            api = kiwimark.KiwiMarkup(highlight = True)
+            api.highlighter = self.highlighter
+            api.execute(lines)
+            self.assertEqual(api.output[:5], ["<pre>", "<code class='language-python'>",
+                                              "<span class='k'>pass</span>", "</code>", "</pre>"])
+            self.assertEqual(api.output[5:], ["<pre>", "<code>", "&lt;pass&gt;", "</code>", "</pre>"])
+
+    @unittest.skipUnless(kiwimark.pygments, "Pygments is not installed")
+    class KiwiPygmentsCase(unittest.TestCase):
+
+        def setUp(self):
+            self.highlighter = kiwimark.KiwiHighlighter()
+
+        def testLines(self):
+            """ Verify that Pygments returns one line for each line of code """
+            for text in ("x = 1", "x = 1\n", "\n", "def f():\n\n    pass\n\n"):
+                lines = self.highlighter.highlight("python", text)
+                self.assertEqual(len(lines), text.count("\n") + 1, repr(text))
+            self.assertTrue('<span class="k">def</span>' in self.highlighter.highlight("python", "def f(): pass")[0])
+
+        def testTrailingBlankLine(self):
+            """ Verify that a code section ending in a blank line is still highlighted """
+            api = kiwimark.KiwiMarkup(highlight = True, sourceMap = True)
+            api.highlighter = self.highlighter
+            api.execute(["code:python", "    x = 1", "    ", ":code"])
+            self.assertEqual(api.output[2:4], ['<span class="n">x</span> <span class="o">=</span> <span class="mi">1</span>', ""])
+            self.assertEqual(api.sourceMap[2:4], [(2, 2), (3, 3)])
+
+    class KiwiSourceMapCase(unittest.TestCase):
+
+        lines = ["Title", "======", "", "Para one", "para two", "", "a | b |", "---|---|", "1 | 2 |"]
+
+        def testSourceMap(self):
+            """ Verify that each output entry maps back to its input lines """
+            api = kiwimark.KiwiMarkup(sourceMap = True)
+            api.execute(self.lines)
+            self.assertEqual(len(api.sourceMap), len(api.output))
+            mapping = list(zip(api.output, api.sourceMap))
+            # Underlines and dividers belong to the line they apply to
+            self.assertEqual(mapping[0], ("<h1>Title</h1>", (1, 2)))
+            self.assertEqual(mapping[1:5], [("<p>", (4, 4)), ("Para one", (4, 4)),
+                                            ("para two", (5, 5)), ("</p>", (6, 6))])
+            self.assertEqual(mapping[6], ("    <tr>", (7, 8)))
+            self.assertEqual(mapping[-1], ("</table>", (9, 9)))
+
+        def testCompactSourceMap(self):
+            """ Verify that joined entries cover all of their input lines """
+            api = kiwimark.KiwiMarkup(sourceMap = True, compact = True)
+            api.execute(self.lines)
+            self.assertEqual(api.sourceMap, [(1, 4), (5, 9)])
+
+        def testParallelSourceMap(self):
+            """ Verify that the line numbers are the same when rendered in parallel """
+            with open("input.txt") as f:
+                lines = f.readlines() * 20
+            serial = kiwimark.KiwiMarkup(sourceMap = True)
+            serial.execute(lines)
+            parallel = kiwimark.KiwiMarkup(sourceMap = True)
+            parallel.executeParallel(lines, workers = 2, minChunkLines = 50)
+            self.assertEqual(parallel.sourceMap, serial.sourceMap)
+
+        def testDisabled(self):
+            """ Verify that there is no source map unless requested """
+            api = kiwimark.KiwiMarkup()
+            api.execute(self.lines)
+            self.assertEqual(api.sourceMap, None)
+
+    class KiwiFolderCase(unittest.TestCase):
+        """ Base class for the tests which need a temporary folder, with a source tree """
+
+        def setUp(self):
+            self.folder = tempfile.mkdtemp()
+            self.source = os.path.join(self.folder, "source")
+            self.target = os.path.join(self.folder, "target")
+            os.makedirs(self.source)
+
+        def tearDown(self):
+            shutil.rmtree(self.folder)
+
+        def write(self, path, content):
+            """ Writes a file (text or bytes) in the source tree, creating its folder """
+            path = os.path.join(self.source, *path.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            with open(path, "wb" if isinstance(content, bytes) else "w") as f:
+                f.write(content)
+
+    class KiwiBuildCase(KiwiFolderCase):
+
+        def setUp(self):
+            KiwiFolderCase.setUp(self)
+            self.write("index.txt", "# Index\n\nSee [page](sub/page.html).\n")
+            self.write("sub/page.md", "# Page\n\nSome text.\n")
+            self.write("notes.dat", "Not a source file\n")
+
+        def testBuild(self):
+            """ Verify that all the source files are rendered """
+            build = kiwimark.KiwiBuild(self.source, self.target, workers = 2)
+            self.assertEqual(sorted(build.execute()), ["index.txt", os.path.join("sub", "page.md")])
+            with open(os.path.join(self.target, "sub", "page.html")) as f:
+                self.assertEqual(f.read(), "<h1>Page</h1>\n<p>\nSome text.\n</p>")
+            self.assertFalse(os.path.exists(os.path.join(self.target, "notes.html")))
+            self.assertFalse(os.path.exists(os.path.join(self.target, "index.html.gz")))
+
+        def testCompress(self):
+            """ Verify the compressed copies, and that unchanged pages are skipped """
+            kiwimark.KiwiBuild(self.source, self.target, workers = 1, compress = True).execute()
+            page = os.path.join(self.target, "index.html")
+            with open(page, "rb") as f:
+                html = f.read()
+            with gzip.open(page + ".gz", "rb") as f:
+                self.assertEqual(f.read(), html)
+
+            # Nothing has changed, so nothing is written or compressed
+            os.utime(page + ".gz", (0, 0))
+            build = kiwimark.KiwiBuild(self.source, self.target, workers = 1, compress = True)
+            self.assertEqual(build.execute(), [])
+            self.assertEqual(os.path.getmtime(page + ".gz"), 0)
+
+            # Only the changed page is written and compressed again
+            self.write("index.txt", "# Index\n\nChanged.\n")
+            self.assertEqual(build.execute(), ["index.txt"])
+            self.assertNotEqual(os.path.getmtime(page + ".gz"), 0)
+            with gzip.open(page + ".gz", "rb") as f:
+                self.assertTrue(b"Changed." in f.read())
+
+        def testManyFolders(self):
+            """ Verify that workers creating the same target folders do not fail """
+            for number in range(400):
+                self.write("d%d/page%d.txt" % (number % 40, number), "# Page %d\n" % number)
+            build = kiwimark.KiwiBuild(self.source, self.target, workers = 8)
+            self.assertEqual(len(build.execute()), 402)
+            self.assertTrue(os.path.exists(os.path.join(self.target, "d39", "page399.html")))
+
+        def testRemovedPages(self):
+            """ Verify that the outputs of deleted sources and stale compressed copies are removed """
+            kiwimark.KiwiBuild(self.source, self.target, workers = 1, compress = True).execute()
+            os.remove(os.path.join(self.source, "sub", "page.md"))
+            kiwimark.KiwiBuild(self.source, self.target, workers = 1).execute()
+            self.assertFalse(os.path.exists(os.path.join(self.target, "sub", "page.html")))
+            self.assertFalse(os.path.exists(os.path.join(self.target, "sub", "page.html.gz")))
+            self.assertTrue(os.path.exists(os.path.join(self.target, "index.html")))
+            self.assertFalse(os.path.exists(os.path.join(self.target, "index.html.gz")))
+
+    class KiwiSearchIndexCase(KiwiFolderCase):
+
+        def setUp(self):
+            KiwiFolderCase.setUp(self)
+            self.write("index.txt", "# A **Kiwi** Index\n\nAll about the **kiwi** bird.\n")
+            self.write("other.txt", "Intro text.\n\n# Other\n\n* A kiwi-fruit item\n    code\n")
+
+        def read(self, name):
+            with open(os.path.join(self.target, "search", name)) as f:
+                return json.load(f)
+
+        def testCollectText(self):
+            """ Verify that the plain text is collected with its section anchor """
+            api = kiwimark.KiwiMarkup(collectText = True)
+            api.execute(["Intro", "", "# A [site](x.html)", "Some **bold** &amp; text", "* Item", "    block"])
+            self.assertEqual(api.metadata.text, [("", "Intro"), ("a-site", "A site"),
+                                                 ("a-site", "Some bold & text"),
+                                                 ("a-site", "Item")])
+
+        def testSearchIndex(self):
+            """ Verify the pages and the sharded postings """
+            kiwimark.KiwiBuild(self.source, self.target, workers = 1, searchIndex = True).execute()
+            ids = kiwimark.KiwiBuild.pageIds(["index.html", "other.html"])
+            self.assertEqual(self.read("pages.json"), {ids["index.html"]: {"url": "index.html", "title": "A Kiwi Index"},
+                                                      ids["other.html"]: {"url": "other.html", "title": "Other"}})
+            self.assertEqual(self.read("ki.json")["kiwi"], [[ids["index.html"], "a-kiwi-index"],
+                                                            [ids["other.html"], "other"]])
+            self.assertEqual(self.read("in.json")["intro"], [[ids["other.html"], ""]])
+            # Block text is not indexed
+            self.assertFalse(os.path.exists(os.path.join(self.target, "search", "co.json")))
+
+        def testUnchangedPages(self):
+            """ Verify that unchanged pages keep their postings without tokenizing """
+            build = kiwimark.KiwiBuild(self.source, self.target, workers = 1, searchIndex = True)
+            build.execute()
+            tokenized = []
+            pageTerms = kiwimark.KiwiBuild.pageTerms
+            def countingPageTerms(text):
+                tokenized.append(text)
+                return pageTerms(text)
+            kiwimark.KiwiBuild.pageTerms = staticmethod(countingPageTerms)
+            try:
+                self.write("index.txt", "# Kiwi Index\n\nAll about the takahe.\n")
+                build.execute()
+            finally:
+                kiwimark.KiwiBuild.pageTerms = staticmethod(pageTerms)
+            self.assertEqual(len(tokenized), 1)
+            ids = kiwimark.KiwiBuild.pageIds(["index.html", "other.html"])
+            self.assertEqual(self.read("ta.json")["takahe"], [[ids["index.html"], "kiwi-index"]])
+            self.assertEqual(self.read("ki.json")["kiwi"], [[ids["index.html"], "kiwi-index"],
+                                                            [ids["other.html"], "other"]])
+
+        def testNewPage(self):
+            """ Verify that adding a page only changes the shards holding its terms """
+            build = kiwimark.KiwiBuild(self.source, self.target, workers = 1, searchIndex = True)
+            build.execute()
+            folder = os.path.join(self.target, "search")
+            before = {}
+            for name in os.listdir(folder):
+                os.utime(os.path.join(folder, name), (0, 0))
+                with open(os.path.join(folder, name), "rb") as f:
+                    before[name] = f.read()
+            # Sorted first, so it would have renumbered all the other pages
+            self.write("aardvark.txt", "# Aardvark\n\nStripes.\n")
+            build.execute()
+            changed = [name for name in os.listdir(folder) if os.path.getmtime(os.path.join(folder, name)) != 0]
+            self.assertEqual(sorted(changed), ["aa.json", "pages.json", "st.json"])
+            for name in before:
+                if name not in changed:
+                    with open(os.path.join(folder, name), "rb") as f:
+                        self.assertEqual(f.read(), before[name])
+
+    class KiwiLinkCheckerCase(KiwiFolderCase):
+
+        def setUp(self):
+            KiwiFolderCase.setUp(self)
+            self.write("sub/graphics/ok.png", b"")
+            self.write("index.txt", "\n".join([
+                "# Index",
+                "[Page](sub/page.html) [Gone](gone.html) [Web](http://example.com/x.html)",
+                "[Top](#index) [Mail](mailto:someone@example.com) [[/sub/page.html?x=1#top][Org]]",
+                "Note[^1] and note[^2].",
+                "[^1]: The first note.",
+                "[^3]: An orphan note.",
+                "code:",
+                "    [Code](not-checked.html)",
+                ":code",
+            ]))
+            self.write("sub/page.md", "\n".join([
+                "[img:Fine](graphics/ok.png) ![Missing](graphics/missing.png)",
+                "[link.nav:Up](../index.html) [Out](../../outside.html)",
+            ]))
+
+        def testCheck(self):
+            """ Verify that the broken references are reported """
+            for workers in (1, 2):
+                checker = kiwimark.KiwiLinkChecker(self.source, workers = workers)
+                self.assertEqual(checker.execute(), [
+                    ("index.txt", checker.MISSING_FOOTNOTE_REFERENCE, "3"),
+                    ("index.txt", checker.MISSING_FOOTNOTE_TARGET, "2"),
+                    ("index.txt", checker.MISSING_FILE, "gone.html"),
+                    ("sub/page.md", checker.MISSING_FILE, "../../outside.html"),
+                    ("sub/page.md", checker.MISSING_IMAGE, "graphics/missing.png"),
+                ])
+
+        def testUnreadable(self):
+            """ Verify that a file which is not UTF-8 is reported, and the others still checked """
+            self.write("latin.txt", u"Caf\u00e9 [Gone](gone.html)\n".encode("latin-1"))
+            for workers in (1, 2):
+                checker = kiwimark.KiwiLinkChecker(self.source, workers = workers)
+                problems = checker.execute()
+                unreadable = [problem for problem in problems if problem[0] == "latin.txt"]
+                self.assertEqual([problem[:2] for problem in unreadable], [("latin.txt", checker.UNREADABLE)])
+                self.assertTrue("utf-8" in unreadable[0][2])
+                self.assertEqual(len(problems), 6)
+
+    class KiwiBytesCase(unittest.TestCase):
+
+        def render(self, data):
+            """ Reference rendering: decode, execute and encode """
+            api = kiwimark.KiwiMarkup()
+            api.execute(io.TextIOWrapper(io.BytesIO(data), encoding = "utf-8").readlines())
+            return "\n".join(api.output).encode("utf-8")
+
+        def testReferenceDocument(self):
+            """ Verify that the bytes path matches the text path """
+            with open("input.txt", "rb") as f:
+                data = f.read()
+            self.assertEqual(kiwimark.KiwiMarkup().executeBytes(data), self.render(data))
+
+        def testLineEndings(self):
+            """ Verify that CR and CRLF line endings are handled """
+            data = b"Header\r\n======\r\n\r\nOne\rTwo\n* Item"
+            self.assertEqual(kiwimark.KiwiMarkup().executeBytes(data), self.render(data))
+
+        def testNonAscii(self):
+            """ Verify that non-ASCII text survives the round trip """
+            data = u"# Caf\u00e9\n\nSome **na\u00efve** text\u00a0here.\n    <\u00e9>\n".encode("utf-8")
+            self.assertEqual(kiwimark.KiwiMarkup().executeBytes(data), self.render(data))
+
+    class KiwiParallelCase(unittest.TestCase):
+
+        def setUp(self):
+            with open("input.txt") as f:
+                self.lines = f.readlines() * 20
+
+        def testBoundaries(self):
+            """ Verify that chunks only start after a blank line, outside code """
+            api = kiwimark.KiwiMarkup()
+            boundaries = api.findBoundaries(self.lines, 50)
+            self.assertTrue(len(boundaries) > 1)
+            for index in boundaries:
+                self.assertEqual(self.lines[index - 1].strip(), "")
+            # Never split inside a code section
+            self.assertEqual(api.findBoundaries(["code:", ""] + ["x", ""] * 10 + [":code"], 2), [])
+
+        def testIdenticalOutput(self):
+            """ Verify that parallel rendering matches serial rendering """
+            serial = kiwimark.KiwiMarkup(headerIds = True)
+            serial.execute(self.lines)
+            parallel = kiwimark.KiwiMarkup(headerIds = True)
+            parallel.executeParallel(self.lines, workers = 2, minChunkLines = 50)
+            self.assertEqual(parallel.output, serial.output)
+            self.assertEqual(parallel.metadata.headers, serial.metadata.headers)
+            self.assertEqual(parallel.metadata.links, serial.metadata.links)
+            self.assertEqual(parallel.metadata.footnoteRefs, serial.metadata.footnoteRefs)
+
+        def testOpenBlock(self):
+            """ Verify that a PRE block is not split by a skipped underline or a stray ':code' """
+            for marker in ("--------", "========", "---|---|", ":code"):
+                lines = ["Intro", "", "    code", marker, "", "* item", "", "more"]
+                api = kiwimark.KiwiMarkup()
+                self.assertEqual(api.findBoundaries(lines, 3), [7])
+                serial = kiwimark.KiwiMarkup(sourceMap = True)
+                serial.execute(lines)
+                parallel = kiwimark.KiwiMarkup(sourceMap = True)
+                parallel.executeParallel(lines, workers = 2, minChunkLines = 3)
+                self.assertEqual(parallel.output, serial.output)
+                self.assertEqual(parallel.sourceMap, serial.sourceMap)
+
+        def testRandomDocuments(self):
+            """ Verify that parallel rendering matches serial rendering for mixed mark-up """
+            choices = ["Text", "more text", "", "", "    pre", "--------", "========", "* item", "  * sub",
+                       "a | b | c", "---|---|", "code:", ":code", "# Head", "# Head", "## Head **b** x"]
+            generator = random.Random(4)
+            for count in range(30):
+                lines = [generator.choice(choices) for index in range(40)]
+                for options in ({"sourceMap": True}, {"sourceMap": True, "compact": True, "headerIds": True}):
+                    serial = kiwimark.KiwiMarkup(**options)
+                    serial.execute(lines)
+                    parallel = kiwimark.KiwiMarkup(**options)
+                    parallel.executeParallel(lines, workers = 2, minChunkLines = 3)
+                    self.assertEqual(parallel.output, serial.output, lines)
+                    self.assertEqual(parallel.sourceMap, serial.sourceMap, lines)
+
+    class KiwiCheckpointCase(unittest.TestCase):
+
+        def setUp(self):
+            with open("input.txt") as f:
+                self.lines = f.readlines()
+            self.lines += ["", "code:python", "def f(x):", "    return 1", ":code", "", "Last para"]
+
+        def resumeAll(self, splits, **options):
+            """ Renders the lines in pieces, saving the checkpoint as JSON between pieces """
+            api = kiwimark.KiwiMarkup(checkpoint = True, **options)
+            api.execute(self.lines[:splits[0]])
+            splits = list(splits) + [len(self.lines)]
+            for start, end in zip(splits, splits[1:]):
+                checkpoint = json.loads(json.dumps(api.checkpoint))
+                output, sourceMap = api.output, api.sourceMap
+                api = kiwimark.KiwiMarkup(checkpoint = True, **options)
+                api.resume(checkpoint, self.lines[start:end], output, sourceMap)
+            return api
+
+        def testResume(self):
+            """ Verify that resumed rendering matches a full render """
+            for options in ({}, {"compact": True}, {"sourceMap": True, "headerIds": True},
+                            {"highlight": True, "sourceMap": True}):
+                full = kiwimark.KiwiMarkup(**options)
+                full.execute(self.lines)
+                for splits in ([1], [3, 4, 5], [20, 60], list(range(2, len(self.lines), 7))):
+                    api = self.resumeAll(splits, **options)
+                    self.assertEqual(api.output, full.output, (options, splits))
+                    self.assertEqual(api.sourceMap, full.sourceMap, (options, splits))
+
+        def testOptionsMismatch(self):
+            """ Verify that a checkpoint is only used with the same options """
+            api = kiwimark.KiwiMarkup(checkpoint = True)
+            api.execute(self.lines[:10])
+            other = kiwimark.KiwiMarkup(compact = True)
+            self.assertRaises(ValueError, other.resume, api.checkpoint, self.lines[10:], api.output)
+            api.checkpoint["version"] = 0
+            self.assertRaises(ValueError, api.resume, api.checkpoint, self.lines[10:], api.output)
+
+    class KiwiServerCase(KiwiFolderCase):
+
+        def setUp(self):
+            KiwiFolderCase.setUp(self)
+            self.path = os.path.join(self.folder, "kiwimark.sock")
+            with open("input.txt", "rb") as f:
+                self.data = f.read()
+
+        def startServer(self):
+            server = kiwimark.KiwiServer(self.path, workers = 1)
+            server.start()
+            thread = threading.Thread(target = server.serve)
+            thread.start()
+            def stop():
+                server.shutdown()
+                thread.join()
+                self.assertFalse(os.path.exists(self.path))
+            self.addCleanup(stop)
+            return server
+
+        def testDaemon(self):
+            """ Verify that the daemon renders pipelined batches, in order """
+            self.startServer()
+            documents = [self.data, b"Title\n=======\n", b"", b"**bold**\n"] * 5
+            client = kiwimark.KiwiClient(self.path)
+            self.assertRaises(ValueError, client.renderMany, documents)
+            documents = [document for document in documents if document]
+            expected = [kiwimark.KiwiMarkup().executeBytes(document) for document in documents]
+            self.assertEqual(client.renderMany(documents), expected)
+            self.assertTrue(client.connected)
+            client = kiwimark.KiwiClient(self.path, {"compact": True})
+            self.assertEqual(client.render(self.data), kiwimark.KiwiMarkup(compact = True).executeBytes(self.data))
+
+        def testWorkerDied(self):
+            """ Verify that the daemon recovers when a worker process dies """
+            server = self.startServer()
+            client = kiwimark.KiwiClient(self.path)
+            expected = kiwimark.KiwiMarkup().executeBytes(self.data)
+            self.assertEqual(client.render(self.data), expected)
+            for process in list(server.pool._processes.values()):
+                process.kill()
+                process.join()
+            self.assertEqual(client.renderMany([self.data] * 3), [expected] * 3)
+            self.assertTrue(client.connected)
+            # The pool has been replaced, so the daemon renders again
+            self.assertEqual(client.render(self.data), expected)
+            self.assertTrue(client.connected)
+
+        def testFallback(self):
+            """ Verify that documents are rendered in-process without a daemon """
+            client = kiwimark.KiwiClient(self.path)
+            self.assertEqual(client.render(self.data), kiwimark.KiwiMarkup().executeBytes(self.data))
+            self.assertFalse(client.connected)
+            # Errors are the same as through the daemon
+            self.assertRaises(ValueError, client.render, b"")
+
+        def testConnectionClosed(self):
+            """ Verify that documents are rendered in-process when the daemon stops part way through """
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(self.path)
+            listener.listen(1)
+            def acceptAndClose():
+                connection, address = listener.accept()
+                connection.close()
+            thread = threading.Thread(target = acceptAndClose)
+            thread.start()
+            client = kiwimark.KiwiClient(self.path)
+            self.assertEqual(client.renderMany([self.data] * 2), [kiwimark.KiwiMarkup().executeBytes(self.data)] * 2)
+            self.assertFalse(client.connected)
+            thread.join()
+            listener.close()
+
+        def testExistingFile(self):
+            """ Verify that only a stale socket is replaced, never another file """
+            with open(self.path, "w") as f:
+                f.write("notes")
+            self.assertRaises(ValueError, kiwimark.KiwiServer(self.path).start)
+            with open(self.path) as f:
+                self.assertEqual(f.read(), "notes")
+            os.remove(self.path)
+            stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            stale.bind(self.path)
+            stale.close()
+            server = kiwimark.KiwiServer(self.path, workers = 1)
+            server.start()
+            # A file which replaces the socket is not removed on close
+            os.remove(self.path)
+            with open(self.path, "w") as f:
+                f.write("notes")
+            server.close()
+            self.assertTrue(os.path.exists(self.path))
+
+    class KiwiExcerptCase(unittest.TestCase):
+
+        def setUp(self):
+            with open("input.txt") as f:
+                self.lines = f.readlines()
+
+        def testExcerpt(self):
+            """ Verify that the excerpt matches the full render """
+            for compact in (False, True):
+                excerpt = kiwimark.KiwiExcerpt(paragraphs = 2, compact = compact)
+                self.assertTrue(excerpt.execute(self.lines))
+                self.assertEqual((excerpt.title, excerpt.level), ("Reference Document for Kiwimark", 1))
+                self.assertEqual(len(excerpt.paragraphs), 2)
+                full = kiwimark.KiwiMarkup(compact = compact)
+                full.execute(self.lines)
+                for paragraph in excerpt.paragraphs:
+                    self.assertTrue(paragraph in "\n".join(full.output), paragraph)
+            self.assertTrue(excerpt.text.startswith("If the input.txt file is processed"))
+
+        def testCharacters(self):
+            """ Verify that the text is cut to the number of characters """
+            excerpt = kiwimark.KiwiExcerpt(paragraphs = None, characters = 20)
+            excerpt.execute(self.lines)
+            self.assertEqual(len(excerpt.paragraphs), 1)
+            self.assertEqual(excerpt.text, "If the input.txt fil")
+
+        def testEarlyExit(self):
+            """ Verify that only the lines needed are read """
+            lines = iter(self.lines * 1000)
+            excerpt = kiwimark.KiwiExcerpt()
+            excerpt.execute(lines)
+            self.assertEqual(len(list(lines)), len(self.lines) * 1000 - excerpt.lineNumber)
+            self.assertTrue(excerpt.lineNumber < 20)
+            # Without a header the whole document is read
+            excerpt.execute(["one", "", "two"])
+            self.assertEqual((excerpt.title, excerpt.paragraphs), (None, ["<p>\none\n</p>"]))
+            self.assertFalse(excerpt.execute([]))
+
+    class KiwiImageSizesCase(KiwiFolderCase):
+
+        png = b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x01\x00\x00\x00\x00\x80\x08\x02\x00\x00\x00"
+        gif = b"GIF89a\x20\x00\x10\x00\x80\x00\x00"
+        # Start of image, an APP0 segment with fill bytes before the next
+        # marker, then the start of frame
+        jpeg = (b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"
+                b"\xff\xff\xc0\x00\x11\x08\x00\x30\x00\x40\x03\x01\x22\x00")
+
+        def setUp(self):
+            KiwiFolderCase.setUp(self)
+            for name, data in (("a.png", self.png), ("b.gif", self.gif), ("c.jpg", self.jpeg),
+                               ("d.png", b"not an image")):
+                self.write("images/" + name, data)
+            self.write("sub/page.txt", "![A](../images/a.png) [img.wide:B](/images/b.gif) ![C](../images/c.jpg)\n"
+                                       "![D](../images/d.png) ![E](http://example.com/e.png)\n")
+
+        def testImageSize(self):
+            """ Verify that the sizes are read from the headers """
+            folder = os.path.join(self.source, "images")
+            self.assertEqual(kiwimark.KiwiImageSizes.imageSize(os.path.join(folder, "a.png")), (256, 128))
+            self.assertEqual(kiwimark.KiwiImageSizes.imageSize(os.path.join(folder, "b.gif")), (32, 16))
+            self.assertEqual(kiwimark.KiwiImageSizes.imageSize(os.path.join(folder, "c.jpg")), (64, 48))
+            self.assertEqual(kiwimark.KiwiImageSizes.imageSize(os.path.join(folder, "d.png")), None)
+
+        def testBuild(self):
+            """ Verify that the sizes are added to the img tags, and cached """
+            kiwimark.KiwiBuild(self.source, self.target, workers = 2, imageSizes = True).execute()
+            with open(os.path.join(self.target, "sub", "page.html")) as f:
+                html = f.read()
+            self.assertTrue("<img src='../images/a.png' width='256' height='128' alt='A'" in html)
+            self.assertTrue("<img src='/images/b.gif' width='32' height='16' class='wide'" in html)
+            self.assertTrue("<img src='../images/c.jpg' width='64' height='48' alt='C'" in html)
+            self.assertTrue("<img src='../images/d.png' alt='D'" in html)
+            self.assertTrue("<img src='http://example.com/e.png' alt='E'" in html)
+
+            # Unchanged images are not read again, so a doctored cache entry
+            # is used as-is
+            cache = os.path.join(self.target, kiwimark.KiwiImageSizes.CACHE)
+            with open(cache) as f:
+                entries = json.load(f)
+            entries["images"]["images/a.png"][2:] = [1, 2]
+            with open(cache, "w") as f:
+                json.dump(entries, f)
+            build = kiwimark.KiwiBuild(self.source, self.target, workers = 1, imageSizes = True)
+            self.assertEqual(build.execute(), ["sub/page.txt".replace("/", os.sep)])
+            with open(os.path.join(self.target, "sub", "page.html")) as f:
+                self.assertTrue("<img src='../images/a.png' width='1' height='2'" in f.read())
+
+    class KiwiShardCase(KiwiFolderCase):
+
+        def setUp(self):
+            KiwiFolderCase.setUp(self)
+            for number in range(30):
+                self.write("part%d/page%d.txt" % (number % 3, number),
+                           "Page %d\n=======\n\nText for page %d.\n" % (number, number))
+
+        def files(self, folder):
+            """ Returns the contents of the files in a folder, except the manifests """
+            files = {}
+            for parent, folders, names in os.walk(folder):
+                for name in names:
+                    if not name.startswith("."):
+                        path = os.path.join(parent, name)
+                        with open(path, "rb") as f:
+                            files[os.path.relpath(path, folder)] = f.read()
+            return files
+
+        def testShardedBuild(self):
+            """ Verify that merged shards, built by separate processes, match a full build """
+            full = os.path.join(self.folder, "full")
+            kiwimark.KiwiBuild(self.source, full, workers = 1, compress = True, searchIndex = True).execute()
+
+            shards = [os.path.join(self.folder, "shard%d" % index) for index in range(3)]
+            processes = [subprocess.Popen([sys.executable, os.path.join("..", "kiwimark", "kiwimark.py"),
+                                           self.source, shard, "--shard", "%d/3" % index, "--gzip",
+                                           "--search-index", "--workers", "1"], stdout = subprocess.PIPE)
+                         for index, shard in enumerate(shards)]
+            for process in processes:
+                process.communicate()
+                self.assertEqual(process.returncode, 0)
+            sizes = [len(self.files(shard)) for shard in shards]
+            self.assertEqual(sum(sizes), 60)
+            self.assertTrue(min(sizes) > 0)
+
+            merged = os.path.join(self.folder, "merged")
+            self.assertEqual(len(kiwimark.KiwiShardMerge(shards, merged).execute()), 30)
+            self.assertEqual(self.files(merged), self.files(full))
+            # Nothing has changed, so nothing is copied
+            self.assertEqual(kiwimark.KiwiShardMerge(shards, merged).execute(), [])
+
+            # Missing and duplicated shards are rejected
+            self.assertRaises(ValueError, kiwimark.KiwiShardMerge(shards[:2], merged).execute)
+            self.assertRaises(ValueError, kiwimark.KiwiShardMerge(shards + shards[:1], merged).execute)
+            self.assertRaises(ValueError, kiwimark.KiwiShardMerge(shards + [full], merged).execute)
+
+        def testShardOf(self):
+            """ Verify that every file is in exactly one shard """
+            paths = kiwimark.KiwiBuild(self.source, None).sources()
+            for count in (1, 2, 7):
+                shards = [kiwimark.KiwiBuild.shardOf(path, count) for path in paths]
+                self.assertTrue(all(0 <= shard < count for shard in shards))
+            self.assertEqual(kiwimark.KiwiBuild.shardOf("part0/page0.txt", 7),
+                             kiwimark.KiwiBuild.shardOf(os.path.join("part0", "page0.txt"), 7))
+
+    class KiwiRenderCacheCase(KiwiFolderCase):
+
+        def setUp(self):
+            KiwiFolderCase.setUp(self)
+            self.path = os.path.join(self.folder, "cache.db")
+            with open("input.txt", "rb") as f:
+                self.data = f.read()
+
+        def testRender(self):
+            """ Verify that pages are shared between cache instances, by options """
+            expected = kiwimark.KiwiMarkup().executeBytes(self.data)
+            cache = kiwimark.KiwiRenderCache(self.path)
+            self.assertEqual(cache.render(self.data), expected)
+            # Another connection, as another process would have, finds the page
+            other = kiwimark.KiwiRenderCache(self.path)
+            key = other.key(self.data)
+            self.assertEqual(other.get(key), expected)
+            other.put(key, b"cached")
+            self.assertEqual(cache.render(self.data), b"cached")
+            # Different options are cached separately
+            compact = {"compact": True}
+            self.assertNotEqual(other.key(self.data, options = compact), key)
+            self.assertEqual(cache.render(self.data, options = compact),
+                             kiwimark.KiwiMarkup(compact = True).executeBytes(self.data))
+            cache.clear()
+            self.assertEqual(other.get(key), None)
+
+        def testEviction(self):
+            """ Verify that the least recently used pages are removed """
+            cache = kiwimark.KiwiRenderCache(self.path, maxBytes = 250)
+            keys = ["key%d" % number for number in range(4)]
+            for number, key in enumerate(keys):
+                cache.put(key, b"x" * 100)
+                cache.connection().execute("UPDATE pages SET used = ? WHERE key = ?", (number, key))
+            self.assertEqual([cache.get(key) is not None for key in keys], [False, False, True, True])
+
+        def testThreads(self):
+            """ Verify that other threads use the cache too """
+            cache = kiwimark.KiwiRenderCache(self.path)
+            cache.render(self.data)
+            key = cache.key(self.data)
+            results = []
+            def useCache():
+                results.append(cache.get(key))
+                cache.put("other", b"from a thread")
+            thread = threading.Thread(target = useCache)
+            thread.start()
+            thread.join()
+            self.assertEqual(results, [kiwimark.KiwiMarkup().executeBytes(self.data)])
+            self.assertEqual(cache.get("other"), b"from a thread")
+
+        def testTotalSize(self):
+            """ Verify that the running total matches the pages """
+            cache = kiwimark.KiwiRenderCache(self.path, maxBytes = 250)
+            db = cache.connection()
+            for key, size in (("a", 100), ("b", 50), ("a", 20), ("c", 100), ("d", 100)):
+                cache.put(key, b"x" * size)
+                self.assertEqual(db.execute("SELECT size FROM total").fetchone()[0],
+                                 db.execute("SELECT TOTAL(size) FROM pages").fetchone()[0])
+            self.assertTrue(db.execute("SELECT size FROM total").fetchone()[0] <= 250)
+            cache.clear()
+            self.assertEqual(db.execute("SELECT size FROM total").fetchone()[0], 0)
+
+        def testProcesses(self):
+            """ Verify that worker processes share the cache """
+            documents = [self.data + (b"\nPage %d\n" % number) for number in range(4)]
+            with ProcessPoolExecutor(max_workers = 2) as executor:
+                rendered = list(executor.map(kiwimark.KiwiRenderCache(self.path).render, documents))
+            cache = kiwimark.KiwiRenderCache(self.path)
+            self.assertEqual([cache.get(cache.key(document)) for document in documents], rendered)
+
+    class KiwiRenderManyCase(unittest.TestCase):
+
+        snippets = ["Some **bold** text", "* one\n* two", "**unclosed bold and _emph", "plain text",
+                    "", "-*- mode: org -*-\n* Org header", "a | b |\n---|---|\n1 | 2 |", "code:\nx\n",
+                    "Line one\r\nline two\r\n"]
+
+        def render(self, snippet):
+            """ Renders a snippet with a new instance """
+            if not snippet:
+                return ""
+            api = kiwimark.KiwiMarkup()
+            api.execute(kiwimark.KiwiMarkup.splitLines(snippet))
+            return "\n".join(api.output)
+
+        def testRenderMany(self):
+            """ Verify that each snippet is rendered as if on its own """
+            expected = [self.render(snippet) for snippet in self.snippets]
+            api = kiwimark.KiwiMarkup()
+            self.assertEqual(api.renderMany(self.snippets), expected)
+            # Reversed, so each snippet follows a different one
+            self.assertEqual(api.renderMany(reversed(self.snippets)), expected[::-1])
+
+        def testParallel(self):
+            """ Verify that the results are in order when fanned out to workers """
+            snippets = self.snippets * 20
+            api = kiwimark.KiwiMarkup(compact = True)
+            self.assertEqual(api.renderMany(snippets, workers = 2, minParallel = 10), api.renderMany(snippets))
+
+        def testHorizontalLine(self):
+            """ Verify that the lines after a horizontal line are not also horizontal lines """
+            api = kiwimark.KiwiMarkup()
+            api.execute(["----------", "", "text"])
+            self.assertEqual(api.output, ["<hr>", "<p>", "text", "</p>"])
+
     unittest.main()
 
 